@@ -13,10 +13,17 @@
 #
 # By Stefan Midjich
 
+import mmap
 from sys import exit
 import argparse
+from datetime import datetime
+from socket import inet_aton
+from struct import unpack
 from netaddr import IPNetwork
 
+# Binding states of leases that are in use
+ACTIVE_STATES = ['active']
+
 def main():
     arse = argparse.ArgumentParser(
         description = 'Count leases in use for one subnet',
@@ -36,6 +43,15 @@ def main():
         help = 'Leases filename'
     )
 
+    arse.add_argument(
+        '-s', '--state',
+        action = 'append',
+        dest = 'states',
+        metavar = 'active',
+        help = 'Binding state of leases to count, can be given more than '
+               'once. Default is active.'
+    )
+
     arse.add_argument(
         'subnet',
         metavar = '10.11.12.13/29',
@@ -46,63 +62,177 @@ def main():
 
     try:
         ip = IPNetwork(args.subnet)
-        range_ips = list(ip)
     except:
         arse.print_usage()
         exit(1)
 
-    valid_ips = []
-    for _ip in range_ips:
-        valid_ips.append(str(_ip))
-
-    matches = count(args.filename, valid_ips)
+    # Addresses are compared as integers, without listing the subnet
+    matches = count(
+        args.filename,
+        (ip.first, ip.last),
+        args.states or ACTIVE_STATES
+    )
 
     if args.quiet:
         print len(matches)
     else:
         print "Found %d leases out of %d, for subnet %s" % (
             len(matches), 
-            len(valid_ips),
+            ip.size,
             args.subnet
         )
 
-def count(file, valid_ips):
-    matched_ips = {}
+def ip_to_int(ip):
+    return unpack('!I', inet_aton(ip))[0]
+
+def in_range(ip, valid_range):
+    (first, last) = valid_range
+    try:
+        return first <= ip_to_int(ip) <= last
+    except Exception:
+        return False
+
+# Times in dhcpd.leases are "<weekday> <date> <time>" in UTC, "epoch 
+# <seconds>; # <date>" with db-time-format local, or never. 
+def parse_time(value):
+    value = value.split('#')[0].strip().rstrip(';')
+    if value == 'never':
+        return None
+    try:
+        (weekday, rest) = value.split(' ', 1)
+        if weekday == 'epoch':
+            return datetime.utcfromtimestamp(int(rest))
+        return datetime.strptime(rest, '%Y/%m/%d %H:%M:%S')
+    except ValueError:
+        return None
+
+# Fields of a lease besides its binding state as dhcpd writes them, indented
+# by two spaces, and how they are parsed. 
+LEASE_FIELDS = [
+    ('starts', b'\n  starts ', parse_time),
+    ('ends', b'\n  ends ', parse_time),
+    ('hardware', b'\n  hardware ethernet ', None),
+    ('hostname', b'\n  client-hostname ', lambda value: value.strip('"')),
+]
+
+# Reads whole lease { ... } blocks from dhcpd.leases and yields the 
+# IP-address, a dictionary of each lease and the offset in the file after 
+# it, in the order they are in the file. offset is where file is read from. 
+# The file is mapped into memory and searched as bytes for the start and end
+# of lease blocks, only the fields of leases wanted(ip, state) returns true 
+# for are decoded, the others only have their state. 
+def read_leases(file, offset=0, wanted=None):
+    try:
+        leases = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (EnvironmentError, ValueError):
+        # Not a regular file, or an empty one
+        for lease in read_lease_lines(file, offset):
+            yield lease
+        return
+
+    try:
+        start = leases.find(b'lease ', offset)
+        while start != -1:
+            if start > 0 and leases[start - 1:start] != b'\n':
+                start = leases.find(b'lease ', start + 1)
+                continue
+
+            # The closing brace of nested blocks is indented
+            end = leases.find(b'\n}', start)
+            if end == -1:
+                return
+            end += 2
+            if leases[end:end + 1] == b'\n':
+                end += 1
+
+            current_ip = leases[
+                start + 6:leases.find(b' ', start + 6, end)
+            ].decode('ascii')
+            # dhcpd before 3.0 wrote no binding state
+            state = lease_value(leases, b'\n  binding state ', start, end)
+            lease = {'state': state or 'active'}
+            if wanted is None or wanted(current_ip, lease['state']):
+                for (field, name, parse_value) in LEASE_FIELDS:
+                    value = lease_value(leases, name, start, end)
+                    if value is not None and parse_value is not None:
+                        value = parse_value(value)
+                    lease[field] = value
+
+            yield (current_ip, lease, end)
+            start = leases.find(b'lease ', end)
+    finally:
+        leases.close()
+
+# Value of the field starting with name in leases, from start to end. 
+def lease_value(leases, name, start, end):
+    i = leases.find(name, start, end)
+    if i == -1:
+        return None
+    i += len(name)
+    value = leases[i:leases.find(b'\n', i, end)].rstrip(b';')
+    return value.decode('ascii', 'replace')
+
+# Reads whole lease { ... } blocks from dhcpd.leases, one line at a time, 
+# like read_leases() for files that can not be mapped into memory. dhcpd 
+# escapes everything but printable ASCII in the file, so a character is a 
+# byte. 
+def read_lease_lines(file, offset=0):
+    current_ip = None
+    depth = 0
     for line in file:
-        if line.startswith('lease '):
-            (junk, current_ip, junk) = line.split(' ')
-            if current_ip in valid_ips:
-                try:
-                    matched_ips[current_ip]['count'] += 1
-                except:
-                    matched_ips[current_ip] = {
-                        'count': 1,
-                        'starts': None,
-                        'ends': None
-                    }
-        else:
-            if line.lstrip(' ').startswith('starts '):
-                (
-                    junk1,
-                    junk2,
-                    date,
-                    time
-                ) = line.lstrip(' ').split(' ')
-                try:
-                    matched_ips[current_ip]['starts'] = date
-                except:
-                    pass
-            if line.lstrip(' ').startswith('ends '):
-                (
-                    junk1,
-                    junk2,
-                    date,
-                    time
-                ) = line.lstrip(' ').split(' ')
-                try:
-                    matched_ips[current_ip]['ends'] = date
-                except:
-                    pass
+        offset += len(line)
+        line = line.strip()
+        if current_ip is None:
+            if line.startswith('lease ') and line.endswith('{'):
+                current_ip = line.split(' ')[1]
+                lease = {
+                    # dhcpd before 3.0 wrote no binding state
+                    'state': 'active',
+                    'starts': None,
+                    'ends': None,
+                    'hardware': None,
+                    'hostname': None
+                }
+                depth = 1
+            continue
+
+        # Skip nested blocks like on expiry { ... }
+        if line.endswith('{'):
+            depth += 1
+            continue
+        if line.startswith('}'):
+            depth -= 1
+            if depth == 0:
+                yield (current_ip, lease, offset)
+                current_ip = None
+            continue
+        if depth > 1:
+            continue
+
+        line = line.rstrip(';')
+        if line.startswith('binding state '):
+            lease['state'] = line[14:]
+        elif line.startswith('starts '):
+            lease['starts'] = parse_time(line[7:])
+        elif line.startswith('ends '):
+            lease['ends'] = parse_time(line[5:])
+        elif line.startswith('hardware ethernet '):
+            lease['hardware'] = line[18:]
+        elif line.startswith('client-hostname '):
+            lease['hostname'] = line[16:].strip('"')
+
+# Last record of every lease in valid_range, dhcpd appends a new record every 
+# time a lease changes. Only leases in one of states are kept. 
+def count(file, valid_range, states=ACTIVE_STATES):
+    def wanted(ip, state):
+        return state in states and in_range(ip, valid_range)
+
+    matched_ips = {}
+    for (current_ip, lease, end) in read_leases(file, 0, wanted):
+        if lease['state'] not in states:
+            matched_ips.pop(current_ip, None)
+        elif in_range(current_ip, valid_range):
+            matched_ips[current_ip] = lease
     return matched_ips
 
 if __name__ == '__main__':
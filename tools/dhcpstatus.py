@@ -1,5 +1,7 @@
 #!/usr/bin/env python
 # Create status info of ISC DHCPd leases in JSON format.
+# Can also output the utilization of pools as JSON, Nagios plugin output or
+# Munin plugin values.
 # 
 # Depends on python module netaddr.
 #   Install with pip install netaddr.
@@ -16,61 +18,405 @@
 
 from __future__ import print_function
 
+import os
+import re
+import mmap
 from sys import exit, stderr, stdout
 from argparse import ArgumentParser, FileType
-from json import dumps
+from json import dumps, dump, load
+from datetime import datetime
+from bisect import bisect_right
+from socket import inet_aton
+from struct import unpack
 
 from netaddr import IPNetwork
 from iscconf import parse
 
-# This does the actual counting of leases in dhcpd.leases. It takes a list of
-# valid IP-addresses as argument, and a file object to the leases. 
+# Binding states of leases that are in use
+ACTIVE_STATES = ['active']
+
+# Times in dhcpd.leases are "<weekday> <date> <time>" in UTC, "epoch 
+# <seconds>; # <date>" with db-time-format local, or never. 
+def parse_time(value):
+    value = value.split('#')[0].strip().rstrip(';')
+    if value == 'never':
+        return None
+    try:
+        (weekday, rest) = value.split(' ', 1)
+        if weekday == 'epoch':
+            return datetime.utcfromtimestamp(int(rest))
+        return datetime.strptime(rest, '%Y/%m/%d %H:%M:%S')
+    except ValueError:
+        return None
+
+# Fields of a lease besides its binding state as dhcpd writes them, indented
+# by two spaces, and how they are parsed. 
+LEASE_FIELDS = [
+    ('starts', b'\n  starts ', parse_time),
+    ('ends', b'\n  ends ', parse_time),
+    ('hardware', b'\n  hardware ethernet ', None),
+    ('hostname', b'\n  client-hostname ', lambda value: value.strip('"')),
+]
+
+# Reads whole lease { ... } blocks from dhcpd.leases and yields the 
+# IP-address, a dictionary of each lease and the offset in the file after 
+# it, in the order they are in the file. offset is where file is read from. 
+# The file is mapped into memory and searched as bytes for the start and end
+# of lease blocks, only the fields of leases wanted(ip, state) returns true 
+# for are decoded, the others only have their state. 
+def read_leases(file, offset=0, wanted=None):
+    try:
+        leases = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (EnvironmentError, ValueError):
+        # Not a regular file, or an empty one
+        for lease in read_lease_lines(file, offset):
+            yield lease
+        return
+
+    try:
+        start = leases.find(b'lease ', offset)
+        while start != -1:
+            if start > 0 and leases[start - 1:start] != b'\n':
+                start = leases.find(b'lease ', start + 1)
+                continue
+
+            # The closing brace of nested blocks is indented
+            end = leases.find(b'\n}', start)
+            if end == -1:
+                return
+            end += 2
+            if leases[end:end + 1] == b'\n':
+                end += 1
+
+            current_ip = leases[
+                start + 6:leases.find(b' ', start + 6, end)
+            ].decode('ascii')
+            # dhcpd before 3.0 wrote no binding state
+            state = lease_value(leases, b'\n  binding state ', start, end)
+            lease = {'state': state or 'active'}
+            if wanted is None or wanted(current_ip, lease['state']):
+                for (field, name, parse_value) in LEASE_FIELDS:
+                    value = lease_value(leases, name, start, end)
+                    if value is not None and parse_value is not None:
+                        value = parse_value(value)
+                    lease[field] = value
+
+            yield (current_ip, lease, end)
+            start = leases.find(b'lease ', end)
+    finally:
+        leases.close()
+
+# Value of the field starting with name in leases, from start to end. 
+def lease_value(leases, name, start, end):
+    i = leases.find(name, start, end)
+    if i == -1:
+        return None
+    i += len(name)
+    value = leases[i:leases.find(b'\n', i, end)].rstrip(b';')
+    return value.decode('ascii', 'replace')
+
+# Reads whole lease { ... } blocks from dhcpd.leases, one line at a time, 
+# like read_leases() for files that can not be mapped into memory. dhcpd 
+# escapes everything but printable ASCII in the file, so a character is a 
+# byte. 
+def read_lease_lines(file, offset=0):
+    current_ip = None
+    depth = 0
+    for line in file:
+        offset += len(line)
+        line = line.strip()
+        if current_ip is None:
+            if line.startswith('lease ') and line.endswith('{'):
+                current_ip = line.split(' ')[1]
+                lease = {
+                    # dhcpd before 3.0 wrote no binding state
+                    'state': 'active',
+                    'starts': None,
+                    'ends': None,
+                    'hardware': None,
+                    'hostname': None
+                }
+                depth = 1
+            continue
+
+        # Skip nested blocks like on expiry { ... }
+        if line.endswith('{'):
+            depth += 1
+            continue
+        if line.startswith('}'):
+            depth -= 1
+            if depth == 0:
+                yield (current_ip, lease, offset)
+                current_ip = None
+            continue
+        if depth > 1:
+            continue
+
+        line = line.rstrip(';')
+        if line.startswith('binding state '):
+            lease['state'] = line[14:]
+        elif line.startswith('starts '):
+            lease['starts'] = parse_time(line[7:])
+        elif line.startswith('ends '):
+            lease['ends'] = parse_time(line[5:])
+        elif line.startswith('hardware ethernet '):
+            lease['hardware'] = line[18:]
+        elif line.startswith('client-hostname '):
+            lease['hostname'] = line[16:].strip('"')
+
+# This does the actual counting of leases in dhcpd.leases. It takes the
+# ranges of valid IP-addresses from get_valid_ranges() as argument, and a 
+# file object to the leases. 
+# dhcpd appends a new record for a lease every time it changes, so the last
+# record of an IP-address is the one that counts. Only the leases with one 
+# of states as their last binding state are kept. 
 # Return value is a dictionary of matched leases. 
 # Counting can take a long time on big leases files. 
-def count_leases(file, valid_ips):
+def count_leases(file, valid_ranges, states=ACTIVE_STATES):
     matched_ips = {}
-    for line in file:
-        if line.startswith('lease '):
-            (junk, current_ip, junk) = line.split(' ')
-            if current_ip in valid_ips:
-                try:
-                    matched_ips[current_ip]['count'] += 1
-                except:
-                    matched_ips[current_ip] = {
-                        'count': 1,
-                        'starts': None,
-                        'ends': None
-                    }
-        else:
-            if line.lstrip(' ').startswith('starts '):
-                (
-                    junk1,
-                    junk2,
-                    date,
-                    time
-                ) = line.lstrip(' ').split(' ')
-                try:
-                    matched_ips[current_ip]['starts'] = date
-                except:
-                    pass
-            if line.lstrip(' ').startswith('ends '):
-                (
-                    junk1,
-                    junk2,
-                    date,
-                    time
-                ) = line.lstrip(' ').split(' ')
-                try:
-                    matched_ips[current_ip]['ends'] = date
-                except:
-                    pass
+    update_leases(file, matched_ips, states, valid_ranges)
     return matched_ips
 
-def get_valid_ips(subnets, ips):
+# Updates the dictionary leases with the records in file from offset, all 
+# addresses are kept without valid_ranges. Returns the offset after the last
+# whole lease block, a block dhcpd is still writing is read again next time.
+def update_leases(file, leases, states, valid_ranges=None, offset=0):
+    def wanted(ip, state):
+        if state not in states:
+            return False
+        return valid_ranges is None or in_ranges(ip, valid_ranges)
+
+    if offset:
+        file.seek(offset)
+    for (current_ip, lease, end) in read_leases(file, offset, wanted):
+        offset = end
+        if lease['state'] not in states:
+            leases.pop(current_ip, None)
+        elif valid_ranges is None or in_ranges(current_ip, valid_ranges):
+            leases[current_ip] = lease
+    return offset
+
+# The state file keeps the leases in use after the last run and how far the
+# leases file was read, so the next run only reads what dhcpd appended since.
+# dhcpd rewrites the whole leases file now and then, renaming the old one to
+# dhcpd.leases~, which is noticed by its inode. Returns the leases and the 
+# offset to continue from, or None if the leases file has to be read from 
+# the start. 
+def load_state(filename, file, states, verbose=False):
+    try:
+        with open(filename) as f:
+            state = load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+    st = os.fstat(file.fileno())
+    if state.get('states') != sorted(states):
+        return None
+    if (state.get('device'), state.get('inode')) != (st.st_dev, st.st_ino):
+        if verbose:
+            print('Leases file was rewritten, reading all of it', file=stderr)
+        return None
+    if state.get('offset', 0) > st.st_size:
+        if verbose:
+            print('Leases file was truncated, reading all of it', file=stderr)
+        return None
+    return (state['leases'], state['offset'])
+
+def save_state(filename, file, states, leases, offset):
+    st = os.fstat(file.fileno())
+    tmp = filename + '.tmp'
+    with open(tmp, 'w') as f:
+        dump({
+            'device': st.st_dev,
+            'inode': st.st_ino,
+            'offset': offset,
+            'states': sorted(states),
+            'leases': leases
+        }, f, default=lambda d: d.isoformat())
+    os.rename(tmp, filename)
+
+# Subnets become ranges of IP-addresses as integers, so an address is looked 
+# up in them without listing every address of the subnets. Returns the first 
+# and the last addresses of the ranges, sorted, with overlapping ranges 
+# merged. 
+def get_valid_ranges(subnets):
+    ranges = []
     for subnet in subnets:
         _ip = IPNetwork(subnet)
-        for _ip_address in list(_ip):
-            ips.append(str(_ip_address))
+        ranges.append((_ip.first, _ip.last))
+    ranges.sort()
+
+    firsts = []
+    lasts = []
+    for (first, last) in ranges:
+        if lasts and first <= lasts[-1] + 1:
+            lasts[-1] = max(lasts[-1], last)
+        else:
+            firsts.append(first)
+            lasts.append(last)
+    return (firsts, lasts)
+
+def ip_to_int(ip):
+    return unpack('!I', inet_aton(ip))[0]
+
+def in_ranges(ip, ranges):
+    (firsts, lasts) = ranges
+    try:
+        ip = ip_to_int(ip)
+    except Exception:
+        return False
+    i = bisect_right(firsts, ip) - 1
+    return i >= 0 and ip <= lasts[i]
+
+# Words, quoted strings, comments and punctuation of dhcpd.conf. 
+CONFIG_TOKENS = re.compile(r'"(?:[^"\\]|\\.)*"|#[^\n]*|[{};]|[^\s{};"#]+')
+
+# Yields the shared-network name, first and last address of every range 
+# statement in the text of dhcpd.conf, also those in pool blocks. This is 
+# read from the text because iscconf keeps one value per statement, so of 
+# two pools or two single address ranges in a block only the last is left. 
+def scan_ranges(config):
+    blocks = []
+    words = []
+    for token in CONFIG_TOKENS.findall(config):
+        if token.startswith('#'):
+            continue
+        if token == '{':
+            blocks.append(words)
+            words = []
+        elif token == '}':
+            if blocks:
+                blocks.pop()
+            words = []
+        elif token == ';':
+            if words and words[0] == 'range':
+                # range [dynamic-bootp] first [last];
+                addresses = [w for w in words[1:] if w != 'dynamic-bootp']
+                networks = [
+                    block[1] for block in blocks
+                    if block[:1] == ['shared-network'] and len(block) > 1
+                ]
+                if addresses and networks:
+                    yield (networks[-1], addresses[0], addresses[-1])
+            words = []
+        else:
+            words.append(token.strip('"'))
+
+def usage(total, used):
+    return {
+        'total': total,
+        'used': used,
+        'free': total - used,
+        'percent': round(100.0 * used / total, 2) if total else 0.0
+    }
+
+# Counts the leases in use in every range, subnet and shared-network of 
+# isps, as built from dhcpd.conf below, by looking up each lease once. 
+# Returns a dictionary of ISP-names with their usage and that of their 
+# subnets and ranges. 
+def get_utilization(isps, leases):
+    pools = []
+    for isp in isps:
+        for (subnet, ranges) in isps[isp].get('ranges', {}).items():
+            for _range in ranges:
+                (first, last) = _range.split('-')
+                pools.append((ip_to_int(first), ip_to_int(last), isp, subnet,
+                              _range))
+    pools.sort()
+    firsts = [pool[0] for pool in pools]
+
+    used = {}
+    for ip in leases:
+        try:
+            ip = ip_to_int(ip)
+        except Exception:
+            continue
+        i = bisect_right(firsts, ip) - 1
+        if i >= 0 and ip <= pools[i][1]:
+            used[pools[i][2:]] = used.get(pools[i][2:], 0) + 1
+
+    stats = {}
+    for (first, last, isp, subnet, _range) in pools:
+        isp_stats = stats.setdefault(
+            isp,
+            {'total': 0, 'used': 0, 'subnets': {}}
+        )
+        subnet_stats = isp_stats['subnets'].setdefault(
+            subnet,
+            {'total': 0, 'used': 0, 'ranges': {}}
+        )
+        range_stats = usage(
+            last - first + 1,
+            used.get((isp, subnet, _range), 0)
+        )
+        subnet_stats['ranges'][_range] = range_stats
+        for _stats in (isp_stats, subnet_stats):
+            _stats['total'] += range_stats['total']
+            _stats['used'] += range_stats['used']
+
+    for isp_stats in stats.values():
+        for subnet_stats in isp_stats['subnets'].values():
+            subnet_stats.update(usage(subnet_stats['total'],
+                                      subnet_stats['used']))
+        isp_stats.update(usage(isp_stats['total'], isp_stats['used']))
+    return stats
+
+# Yields the name, and usage, of every shared-network, subnet and range in 
+# stats. 
+def walk_utilization(stats):
+    for isp in sorted(stats):
+        yield (isp, stats[isp])
+        for subnet in sorted(stats[isp]['subnets']):
+            subnet_stats = stats[isp]['subnets'][subnet]
+            yield ('%s %s' % (isp, subnet), subnet_stats)
+            for _range in sorted(subnet_stats['ranges']):
+                yield ('%s %s' % (isp, _range), subnet_stats['ranges'][_range])
+
+# Prints the utilization of the shared-networks as the output of a Nagios 
+# plugin, with the usage of all pools as perfdata. Returns the exit code of
+# the plugin. 
+def print_nagios(stats, warning, critical, file):
+    code = 0
+    for isp_stats in stats.values():
+        if isp_stats['percent'] >= critical:
+            code = 2
+        elif isp_stats['percent'] >= warning:
+            code = max(code, 1)
+
+    perfdata = []
+    for (name, _stats) in walk_utilization(stats):
+        perfdata.append("'%s'=%d;%d;%d;0;%d" % (
+            name,
+            _stats['used'],
+            _stats['total'] * warning // 100,
+            _stats['total'] * critical // 100,
+            _stats['total']
+        ))
+
+    print('DHCP %s - %s | %s' % (
+        ['OK', 'WARNING', 'CRITICAL'][code],
+        ', '.join(
+            '%s %.2f%% used (%d/%d)' % (isp, stats[isp]['percent'],
+                                        stats[isp]['used'],
+                                        stats[isp]['total'])
+            for isp in sorted(stats)
+        ) or 'No pools found',
+        ' '.join(perfdata)
+    ), file=file)
+    return code
+
+# Prints the percent used of all pools as the values of a Munin plugin. 
+def print_munin(stats, file):
+    for (name, _stats) in walk_utilization(stats):
+        field = re.sub('[^A-Za-z0-9_]', '_', name)
+        if not re.match('[A-Za-z_]', field):
+            field = '_' + field
+        print('%s.value %.2f' % (field, _stats['percent']), file=file)
+        print('%s.extinfo %d of %d addresses used' % (
+            field,
+            _stats['used'],
+            _stats['total']
+        ), file=file)
 
 arse = ArgumentParser(
     description = 'Create JSON statistics of used leases in ISC DHCPd',
@@ -94,6 +440,50 @@ arse.add_argument(
     help = 'File containing all leases for ISC DHCPd'
 )
 
+arse.add_argument(
+    '-s', '--state',
+    action = 'append',
+    dest = 'states',
+    metavar = 'active',
+    help = 'Binding state of leases to count, can be given more than once. '
+           'Default is active.'
+)
+
+arse.add_argument(
+    '-S', '--state-file',
+    metavar = '/var/tmp/dhcpstatus.state',
+    default = None,
+    dest = 'state_file',
+    help = 'Only read what was added to the leases file since the last run '
+           'with the same state file'
+)
+
+arse.add_argument(
+    '-u', '--utilization',
+    choices = ['json', 'nagios', 'munin'],
+    default = None,
+    help = 'Output the total, used and free addresses and percent used of '
+           'every range, subnet and shared-network instead of the leases'
+)
+
+arse.add_argument(
+    '-W', '--warning',
+    type = int,
+    default = 80,
+    metavar = 'PERCENT',
+    help = 'Percent used of a shared-network to warn about with nagios '
+           'output, default 80'
+)
+
+arse.add_argument(
+    '-C', '--critical',
+    type = int,
+    default = 90,
+    metavar = 'PERCENT',
+    help = 'Percent used of a shared-network that is critical with nagios '
+           'output, default 90'
+)
+
 arse.add_argument(
     '-L', '--list',
     action = 'store_true',
@@ -135,7 +525,8 @@ if args.indent:
     indent = 4
 
 try:
-    parsed_dhcp_config = parse(args.configuration.read())
+    dhcp_config = args.configuration.read()
+    parsed_dhcp_config = parse(dhcp_config)
 except Exception as e:
     print(str(e), file=stderr)
     arse.print_usage()
@@ -164,6 +555,20 @@ for item in parsed_dhcp_config:
                 except:
                     json_isp[last_isp]['subnets'] = [_subnet]
 
+                json_isp[last_isp].setdefault('ranges', {})[_subnet] = []
+
+# Ranges go with the subnet of their shared-network they are in, whether 
+# they are declared in the subnet or in a pool of the shared-network. 
+for (isp, first, last) in scan_ranges(dhcp_config):
+    for _subnet in json_isp.get(isp, {}).get('subnets', []):
+        if first in IPNetwork(_subnet):
+            json_isp[isp]['ranges'][_subnet].append('%s-%s' % (first, last))
+            break
+    else:
+        print('Range %s-%s of %s is not in any of its subnets' % (
+            first, last, isp
+        ), file=stderr)
+
 # Just list the ISPs and their subnets, and exit. 
 if args.list:
     if args.isp_name == 'any':
@@ -174,14 +579,56 @@ if args.list:
 
 # Else proceed with regular execution of the program. 
 
-# Get a list of valid IP-addresses to search the leases for. 
-search_ips = []
+# Get the ranges of valid IP-addresses to search the leases for. 
+search_subnets = []
 if args.isp_name == 'any':
     for isp in json_isp:
-        get_valid_ips(json_isp[isp]['subnets'], search_ips)
+        search_subnets.extend(json_isp[isp].get('subnets', []))
 else:
-    get_valid_ips(json_isp[args.isp_name]['subnets'], search_ips)
+    search_subnets.extend(json_isp[args.isp_name]['subnets'])
 
-matched_ips = count_leases(args.leases, search_ips)
+valid_ranges = get_valid_ranges(search_subnets)
+states = args.states or ACTIVE_STATES
 
-print(dumps(matched_ips, indent=indent), file=args.output)
+if args.state_file:
+    # Every lease in use is kept in the state file, whatever ISP-name is
+    # asked for.
+    (leases, offset) = load_state(
+        args.state_file,
+        args.leases,
+        states,
+        args.verbose
+    ) or ({}, 0)
+    offset = update_leases(args.leases, leases, states, None, offset)
+    try:
+        save_state(args.state_file, args.leases, states, leases, offset)
+    except (IOError, OSError) as e:
+        print(str(e), file=stderr)
+    matched_ips = dict(
+        (ip, lease) for (ip, lease) in leases.items()
+        if in_ranges(ip, valid_ranges)
+    )
+else:
+    matched_ips = count_leases(args.leases, valid_ranges, states)
+
+if args.utilization:
+    if args.isp_name != 'any':
+        json_isp = {args.isp_name: json_isp[args.isp_name]}
+    utilization = get_utilization(json_isp, matched_ips)
+    if args.utilization == 'nagios':
+        exit(print_nagios(
+            utilization,
+            args.warning,
+            args.critical,
+            args.output
+        ))
+    if args.utilization == 'munin':
+        print_munin(utilization, args.output)
+        exit(0)
+    print(dumps(utilization, indent=indent), file=args.output)
+    exit(0)
+
+print(
+    dumps(matched_ips, indent=indent, default=lambda d: d.isoformat()),
+    file=args.output
+)
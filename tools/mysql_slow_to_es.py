@@ -1,24 +1,64 @@
 #!/usr/bin/env python3
 # coding: utf-8
 
+import io
+import os
 import re
+import bz2
+import csv
+import glob
+import gzip
+import json
+import lzma
 import pytz
+import resource
+import hashlib
+import signal
+import calendar
+from sys import stderr, stdin, stdout
+from math import ceil
+from time import sleep, time, monotonic
+from functools import lru_cache
+from bisect import bisect_left
+from queue import Queue
+from threading import Lock, Thread
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 from argparse import ArgumentParser, FileType
 from configparser import RawConfigParser
 
-from elasticsearch import Elasticsearch
+from elasticsearch import Elasticsearch, TransportError, ConnectionError
+from elasticsearch.serializer import JSONSerializer
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
 
 default_timezone = 'Europe/Amsterdam'
 default_index = 'mysql-slow'
+default_date_format = '%y%m%d %H:%M:%S'
+log_encoding = 'ISO-8859-1'
+read_buffer_size = 1048576
 
 parser = ArgumentParser()
 
 parser.add_argument(
     '-c', '--config',
-    required=True,
     type=FileType('r'),
-    help='Configuration file'
+    help='Configuration file, required for the elasticsearch sink'
 )
 
 parser.add_argument(
@@ -31,11 +71,18 @@ parser.add_argument(
 
 parser.add_argument(
     '--date-format',
-    default='%y%m%d %H:%M:%S',
+    default=default_date_format,
     metavar='DATE_FORMAT',
     help='Mysql slow log Timestamp format according to strftime'
 )
 
+parser.add_argument(
+    '--timezone',
+    default=default_timezone,
+    metavar='TIMEZONE',
+    help='Timezone of the times in the slow log (default: %(default)s)'
+)
+
 parser.add_argument(
     '--start-from',
     metavar='DATE',
@@ -48,169 +95,1767 @@ parser.add_argument(
 
 parser.add_argument(
     'logfile',
-    type=FileType('r', encoding='ISO-8859-1'),
-    help='Mysql slow log file'
+    nargs='+',
+    help=('Mysql slow log files or glob patterns, read oldest first. Files '
+          'ending in .gz, .bz2, .xz or .zst are decompressed on the fly.')
+)
+
+parser.add_argument(
+    '-s', '--state-file',
+    metavar='FILE',
+    help=('Remember how far into the log entries were imported in this '
+          'file, and continue from there on the next run. Follows the log '
+          'to its rotated name if it was rotated since the last run.')
+)
+
+parser.add_argument(
+    '-f', '--follow',
+    action='store_true',
+    default=False,
+    help=('Keep reading the log as it grows, like tail -F, and reopen it '
+          'when it is rotated. Uses inotify if inotify_simple is installed.')
+)
+
+parser.add_argument(
+    '--poll-interval',
+    default=1.0,
+    type=float,
+    metavar='SECONDS',
+    help='How long to wait for the log to grow in --follow mode'
+)
+
+parser.add_argument(
+    '--max-latency',
+    default=5.0,
+    type=float,
+    metavar='SECONDS',
+    help=('In --follow mode, send a partial bulk request once its oldest '
+          'document has waited this long')
+)
+
+parser.add_argument(
+    '--digest',
+    type=int,
+    metavar='SECONDS',
+    help=('Instead of every entry, index one document per query '
+          'fingerprint and time bucket of this many seconds, with count, '
+          'sum, min, max, p95 and p99 of query time, lock time and rows '
+          'examined')
+)
+
+parser.add_argument(
+    '--stats',
+    metavar='FILE',
+    help=('Write a JSON summary of throughput, time spent parsing and '
+          'indexing, Elasticsearch request latencies, how far behind the '
+          'log the last batch was and peak memory use to FILE at exit, - '
+          'to print it')
+)
+
+parser.add_argument(
+    '--stats-interval',
+    type=float,
+    metavar='SECONDS',
+    help='Print throughput every SECONDS while importing'
 )
 
 parser.add_argument(
     '-D', '--dry-run',
     action='store_true',
     default=False,
-    help=('Only print what would be inserted into Elasticsearch, do not'
-          ' insert anything')
+    help=('Only print the documents that would be sent to the sink, do not'
+          ' send anything')
+)
+
+parser.add_argument(
+    '--sink',
+    choices=['elasticsearch', 'ndjson', 'bulk', 'csv', 'parquet'],
+    default='elasticsearch',
+    help=('Where to send documents. ndjson writes one JSON document per '
+          'line, bulk writes an Elasticsearch _bulk body to load later, csv '
+          'and parquet (needs pyarrow) write one column per field.')
+)
+
+parser.add_argument(
+    '-o', '--output',
+    default='-',
+    metavar='FILE',
+    help='Output file for the file sinks, default is stdout'
+)
+
+parser.add_argument(
+    '--bulk-size',
+    default=500,
+    type=int,
+    metavar='DOCS',
+    help=('Max number of documents sent in each bulk request, or written in '
+          'each batch by the file sinks')
+)
+
+parser.add_argument(
+    '--bulk-bytes',
+    default=10485760,
+    type=int,
+    metavar='BYTES',
+    help='Max size in bytes of each bulk request body'
+)
+
+parser.add_argument(
+    '-j', '--jobs',
+    default=1,
+    type=int,
+    metavar='N',
+    help=('Parse the log in chunks using N processes, memory use grows '
+          'with N times --chunk-size')
+)
+
+parser.add_argument(
+    '--chunk-size',
+    default=8388608,
+    type=int,
+    metavar='BYTES',
+    help='Size of chunks the log is split into with --jobs'
 )
 
+parser.add_argument(
+    '--max-retries',
+    default=3,
+    type=int,
+    metavar='N',
+    help=('Retry documents rejected with 429 by Elasticsearch, or failed '
+          'bulk requests, this many times with exponential backoff')
+)
+
+parser.add_argument(
+    '--concurrency',
+    default=1,
+    type=int,
+    metavar='N',
+    help=('Keep up to N bulk requests in flight while parsing goes on, '
+          'parsing pauses when that many more batches are waiting')
+)
+
+
+# Slow log fields that are renamed in documents, others are lowercased with
+# dashes instead of underscores.
+field_names = {
+    'Lock_time': 'block-time',
+    'Id': 'thread-id'
+}
+
+# Fields written by MySQL, Percona Server and MariaDB that are numbers or
+# Yes/No. All other fields are kept as strings, since a value can look like
+# a number in one entry and not in the next, like the hex InnoDB_trx_id.
+float_fields = {
+    'Query_time', 'Lock_time', 'InnoDB_IO_r_wait', 'InnoDB_rec_lock_wait',
+    'InnoDB_queue_wait', 'Pages_read_time'
+}
+int_fields = {
+    'Id', 'Thread_id', 'Rows_sent', 'Rows_examined', 'Rows_affected',
+    'Rows_read', 'Bytes_sent', 'Bytes_received', 'Killed', 'Errno',
+    'Last_errno', 'Tmp_tables', 'Tmp_disk_tables', 'Tmp_table_sizes',
+    'Merge_passes', 'InnoDB_IO_r_ops', 'InnoDB_IO_r_bytes',
+    'InnoDB_pages_distinct', 'Pages_accessed', 'Pages_read', 'Pages_updated',
+    'Pages_prefetched', 'Undo_records_added', 'Old_rows_read', 'Read_first',
+    'Read_last', 'Read_key', 'Read_next', 'Read_prev', 'Read_rnd',
+    'Read_rnd_next', 'Sort_merge_passes', 'Sort_range_count', 'Sort_rows',
+    'Sort_scan_count', 'Created_tmp_disk_tables', 'Created_tmp_tables'
+}
+bool_fields = {
+    'QC_hit', 'QC_Hit', 'Full_scan', 'Full_join', 'Tmp_table',
+    'Tmp_table_on_disk', 'Filesort', 'Filesort_on_disk', 'Priority_queue'
+}
+
+# Cache of slow log field name, with its colon, to document name and value
+# converter.
+field_types = {}
+
+# Lines are parsed as bytes and only the parts that are kept are decoded.
+time_regex = re.compile(br'# Time:\s+(\S+)(?:\s+(\S+))?')
+host_regex = re.compile(br'\s*(\S*)\s*\[([^\]]*)\](?:\s+Id:\s+(\d+))?')
+fields_regex = re.compile(br'\b([A-Z]\w*:) +([^\s:]+)(?=\s|$)')
+key_regex = re.compile(br'[A-Z]\w*:\Z')
+
+yes_no = {b'Yes': True, b'No': False}
+
+
+def parse_default_time(date, clock):
+    """
+    Faster datetime.strptime() of a "# Time: 180101  0:00:01" line in the
+    default date format, for the date and time parts as bytes.
+    """
+
+    if len(date) != 6 or not date.isdigit():
+        raise ValueError('time data {0!r} does not match format {1!r}'.format(
+            date, default_date_format
+        ))
+
+    (hour, minute, second) = clock.split(b':')
+    year = int(date[:2])
+    # Like %y, 69-99 are 1969-1999 and 0-68 are 2000-2068.
+    year += 1900 if year >= 69 else 2000
+
+    return datetime(
+        year, int(date[2:4]), int(date[4:]),
+        int(hour), int(minute), int(second)
+    )
+
+
+def decode_value(value):
+    return value.decode(log_encoding)
+
+
+def field_type(key):
+    key = key[:-1].decode(log_encoding)
+    name = field_names.get(key) or key.lower().replace('_', '-')
+
+    if key in float_fields:
+        convert = float
+    elif key in int_fields:
+        convert = int
+    elif key in bool_fields:
+        convert = yes_no.__getitem__
+    else:
+        convert = decode_value
+
+    return (name, convert)
+
+
+def is_compressed(filename):
+    return filename.endswith(('.gz', '.bz2', '.xz', '.zst'))
+
+
+def open_log(filename):
+    """
+    Open a slow log for reading as bytes in large blocks, decompressing it
+    if the filename says it is compressed. - is stdin.
+    """
+
+    if filename == '-':
+        return stdin.buffer
+
+    if filename.endswith('.gz'):
+        stream = gzip.open(filename)
+    elif filename.endswith('.bz2'):
+        stream = bz2.open(filename)
+    elif filename.endswith('.xz'):
+        stream = lzma.open(filename)
+    elif filename.endswith('.zst'):
+        if zstandard is None:
+            raise RuntimeError('Install zstandard to read {filename}'.format(
+                filename=filename
+            ))
+        stream = zstandard.ZstdDecompressor().stream_reader(
+            open(filename, 'rb'),
+            read_size=read_buffer_size
+        )
+    else:
+        return open(filename, 'rb', buffering=read_buffer_size)
+
+    return io.BufferedReader(stream, buffer_size=read_buffer_size)
+
+
+def close_log(fileobj):
+    """Close a log that has been read, unless it is stdin"""
+
+    if fileobj is not stdin.buffer:
+        fileobj.close()
+
+
+def expand_logfiles(patterns):
+    """
+    List of the files matching patterns, oldest first so that rotated logs
+    are read in chronological order.
+    """
+
+    filenames = []
+    for pattern in patterns:
+        matches = glob.glob(pattern)
+        if not matches and not glob.has_magic(pattern):
+            # Plain filenames are kept to report them if they are missing.
+            matches = [pattern]
+        filenames.extend(match for match in matches
+                         if match not in filenames)
+
+    if '-' in filenames:
+        return filenames
+
+    try:
+        return sorted(filenames,
+                      key=lambda filename: os.stat(filename).st_mtime)
+    except OSError as e:
+        parser.error(str(e))
+
+
+def open_segments(fileobj, filenames):
+    """
+    Segments for iter_segments() that read the open log fileobj and then
+    the logs in filenames, each opened only when it is its turn.
+    """
+
+    yield (fileobj, 0, True)
+    for filename in filenames:
+        yield (open_log(filename), 0, True)
+
+
+def iter_positions(p, fileobj, offset=0, final=True):
+    """
+    Generator of (entry, start, end) tuples parsed by p from the binary
+    fileobj, starting at byte offset. start and end is the byte range of
+    the entry in the file.
+
+    If final is False the file might still be written to, so the last entry
+    is only returned if the file ends with a complete line.
+    """
+
+    if offset:
+        fileobj.seek(offset)
+
+    start = offset
+    lines = 0
+    line = b''
+    for line in fileobj:
+        lines += 1
+        entry = p.process_line(line)
+        if entry:
+            p.lines += lines
+            p.bytes_read += offset - start
+            lines = 0
+            yield (entry, start, offset)
+            start = offset
+        offset += len(line)
+
+    p.lines += lines
+    p.bytes_read += offset - start
+
+    if final or line.endswith(b'\n'):
+        entry = p.flush()
+        if entry:
+            yield (entry, start, offset)
+
+
+def iter_segments(p, segments, retire=close_log):
+    """
+    Generator of (fileobj, stat, entry, start, end) tuples from reading each
+    (fileobj, offset, final) segment in turn with iter_positions().
+
+    retire is called with each fileobj once it has been read.
+    """
+
+    for (fileobj, offset, final) in segments:
+        try:
+            st = os.fstat(fileobj.fileno())
+        except (AttributeError, OSError, io.UnsupportedOperation):
+            # Decompressed streams have no file of their own.
+            st = None
+
+        for (entry, start, end) in iter_positions(p, fileobj, offset, final):
+            yield (fileobj, st, entry, start, end)
+
+        if retire:
+            retire(fileobj)
+
+
+def follow_segments(p, segments, waiter, on_idle=None, retire=close_log):
+    """
+    Like iter_segments() but never ends, the last segment is followed as it
+    grows. The log is reopened by name when it is rotated and read from the
+    start when it is truncated, the rotated log is passed to retire.
+
+    The entry being read is returned once the log has not grown for one
+    wait, since mysql might not have written all of it yet. on_idle is
+    called every time before waiting.
+    """
+
+    for position in iter_segments(p, segments[:-1], retire):
+        yield position
+
+    (fileobj, offset, final) = segments[-1]
+    st = os.fstat(fileobj.fileno())
+    fileobj.seek(offset)
+    start = offset
+    idle = False
+
+    while True:
+        line = fileobj.readline()
+
+        if line.endswith(b'\n'):
+            entry = p.process_line(line)
+            if entry:
+                yield (fileobj, st, entry, start, offset)
+                start = offset
+            offset += len(line)
+            p.lines += 1
+            p.bytes_read += len(line)
+            idle = False
+            continue
+
+        # Leave half written lines for the next read.
+        fileobj.seek(offset)
+
+        if idle and not line:
+            entry = p.flush()
+            if entry:
+                yield (fileobj, st, entry, start, offset)
+                start = offset
+
+        try:
+            current = os.stat(fileobj.name)
+        except FileNotFoundError:
+            current = None
+
+        if current and (current.st_dev, current.st_ino) != (st.st_dev,
+                                                             st.st_ino):
+            # The rest of the old log was read above.
+            entry = p.flush()
+            if entry:
+                yield (fileobj, st, entry, start, offset)
+            if retire:
+                retire(fileobj)
+
+            fileobj = open(fileobj.name, 'rb')
+            st = os.fstat(fileobj.fileno())
+            start = offset = 0
+            idle = False
+            continue
+
+        if current and current.st_size < offset:
+            entry = p.flush()
+            if entry:
+                yield (fileobj, st, entry, start, offset)
+
+            fileobj.seek(0)
+            start = offset = 0
+            idle = False
+            continue
+
+        if on_idle:
+            on_idle()
+        waiter.wait()
+        idle = True
+
+
+class Waiter(object):
+    """
+    Wait for a file to change, with inotify on the directory of the file if
+    inotify_simple is available, otherwise by sleeping interval seconds.
+    """
+
+    def __init__(self, filename, interval):
+        self.interval = interval
+        self.waited = 0.0
+        self._inotify = None
+
+        if INotify is not None:
+            self._inotify = INotify()
+            self._inotify.add_watch(
+                os.path.dirname(os.path.abspath(filename)),
+                flags.MODIFY | flags.CREATE | flags.DELETE |
+                flags.MOVED_FROM | flags.MOVED_TO
+            )
+
+
+    def wait(self):
+        started = monotonic()
+        if self._inotify is None:
+            sleep(self.interval)
+        else:
+            self._inotify.read(timeout=int(self.interval * 1000))
+        self.waited += monotonic() - started
+
+
+def chunk_ranges(fileobj, chunk_size):
+    """
+    Split the binary file fileobj into (start, end) byte ranges of about
+    chunk_size bytes. Every range except the first starts on a "# Time:" or
+    "# User@Host:" line so each one can be parsed on its own.
+    """
+
+    size = os.fstat(fileobj.fileno()).st_size
+    offsets = [0]
+
+    pos = chunk_size
+    while pos < size:
+        fileobj.seek(pos)
+        # Skip the rest of the line we landed in.
+        fileobj.readline()
+
+        while True:
+            start = fileobj.tell()
+            line = fileobj.readline()
+            if not line or line.startswith((b'# Time: ', b'# User@Host: ')):
+                break
+
+        if not line:
+            break
+
+        offsets.append(start)
+        pos = start + chunk_size
+
+    offsets.append(size)
+    return list(zip(offsets, offsets[1:]))
+
+
+def read_range(fileobj, start, end):
+    """Generator of lines from the byte range start-end of fileobj"""
+
+    fileobj.seek(start)
+    pos = start
+    for line in fileobj:
+        if pos >= end:
+            break
+        pos += len(line)
+        yield line
+
+
+def parse_chunk(filename, start, end, date_format):
+    """
+    Parse one byte range of a slow log in a worker process. Returns the
+    entries along with the time and database in effect at the end of the
+    range, which the entries at the start of the next range inherit, and
+    the number of lines read.
+    """
+
+    p = ProcessLog(date_format=date_format)
+
+    with open(filename, 'rb') as fileobj:
+        entries = list(p.iter_entries(read_range(fileobj, start, end)))
+
+    return (entries, p.time, p.schema, p.lines)
+
+
+def iter_entries_parallel(p, filename, date_format, jobs, chunk_size):
+    """
+    Generator yielding entries of filename in file order, which is also
+    timestamp order, while the chunks are parsed in a pool of processes.
+    The lines and bytes of each chunk are added to the counters of p.
+    """
+
+    with open(filename, 'rb') as fileobj:
+        ranges = chunk_ranges(fileobj, chunk_size)
+
+    time = None
+    schema = None
+    pending = deque()
+
+    with ProcessPoolExecutor(jobs) as pool:
+        for (start, end) in ranges:
+            pending.append((end - start, pool.submit(
+                parse_chunk, filename, start, end, date_format
+            )))
+
+            # Keep only a few chunks in flight to bound memory use.
+            if len(pending) > jobs:
+                (entries, time, schema) = merge_chunk(
+                    p, pending.popleft(), time, schema
+                )
+                for entry in entries:
+                    yield entry
+
+        while pending:
+            (entries, time, schema) = merge_chunk(
+                p, pending.popleft(), time, schema
+            )
+            for entry in entries:
+                yield entry
+
+
+def merge_chunk(p, chunk, time, schema):
+    """
+    Fill in the time and database of entries at the start of a chunk from
+    what was in effect at the end of the previous chunk.
+    """
+
+    (size, future) = chunk
+    (entries, last_time, last_schema, lines) = future.result()
+    p.lines += lines
+    p.bytes_read += size
+
+    for entry in entries:
+        if entry['date'] is not None and entry['schema'] is not None:
+            break
+        if entry['date'] is None:
+            entry['date'] = time
+        if entry['schema'] is None:
+            entry['schema'] = schema
+
+    return (entries, last_time or time, last_schema or schema)
+
+
+# Normalizing queries into fingerprints, in order.
+fingerprint_regexes = [
+    (re.compile(r"'(?:[^'\\]|\\.|'')*'|\"(?:[^\"\\]|\\.|\"\")*\""), '?'),
+    (re.compile(r'/\*.*?\*/|(?:--\s|#)[^\n]*', re.S), ' '),
+    (re.compile(r'\b0x[0-9a-f]+\b|(?<![\w.])-?\d+(?:\.\d+)?(?:e[-+]?\d+)?\b',
+                re.I), '?'),
+    (re.compile(r'\s+'), ' '),
+    (re.compile(r'\bin ?\( ?\?(?: ?, ?\?)* ?\)', re.I), 'in(?+)'),
+    (re.compile(r'\bvalues ?(?:\((?:[^()]|\([^()]*\))*\) ?(?:, ?)?)+',
+                re.I), 'values(?+) '),
+]
+
+
+def fingerprint(query):
+    """
+    Normalize a query so that queries only differing in literal values,
+    comments, whitespace, case or the length of IN and VALUES lists have
+    the same fingerprint.
+    """
+
+    for (regex, replacement) in fingerprint_regexes:
+        query = regex.sub(replacement, query)
+    return query.strip().rstrip(';').strip().lower()
+
+
+def doc_id(doc, fields=('timestamp', 'username', 'hostname', 'ip-address',
+                         'thread-id', 'query-time', 'fingerprint')):
+    """
+    Deterministic document ID, so importing the same entry twice hits the
+    same document instead of creating a duplicate.
+    """
+
+    key = '|'.join(str(doc.get(field)) for field in fields)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+class LocalTime(object):
+    """
+    Convert the naive times of the slow log in timezone to UTC.
+
+    Thousands of entries can share the same second, so conversions are
+    cached per second and the timezone is only looked up once. The
+    microseconds of MySQL 5.7 and later times are put back afterwards.
+    """
+
+    def __init__(self, timezone):
+        self._tz = pytz.timezone(timezone)
+        self._second_to_utc = lru_cache(maxsize=4096)(self._to_utc)
 
-def doc_exists(es, doc):
-    res = es.search(index=default_index, body=doc)
 
-    if res['hits']['total'] > 0:
+    def to_utc(self, dt):
+        utc_dt = self._second_to_utc(dt.replace(microsecond=0))
+        return utc_dt.replace(microsecond=dt.microsecond)
+
+
+    def _to_utc(self, dt):
+        try:
+            local_dt = self._tz.localize(dt, is_dst=None)
+        except (pytz.AmbiguousTimeError, pytz.NonExistentTimeError):
+            # The hour around a DST change, pick standard time.
+            local_dt = self._tz.localize(dt, is_dst=False)
+        return local_dt.astimezone(pytz.utc)
+
+
+def percentile(values, percent):
+    """Nearest-rank percentile of a sorted list"""
+
+    return values[max(int(ceil(percent / 100.0 * len(values))) - 1, 0)]
+
+
+class Digest(object):
+    """
+    Aggregate documents per query fingerprint and database in time buckets,
+    like pt-query-digest but streaming.
+
+    Entries are logged in the order queries finish, so a bucket is complete
+    as soon as an entry for a later bucket arrives. Only the values of the
+    open bucket are kept in memory.
+    """
+
+    metrics = ('query-time', 'block-time', 'rows-examined')
+    id_fields = ('timestamp', 'schema', 'fingerprint')
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self._start = None
+        self._groups = {}
+
+
+    def add(self, doc):
+        """Add a document, returns the digests of a finished bucket if any"""
+
+        epoch = calendar.timegm(doc['timestamp'].utctimetuple())
+        start = epoch - epoch % self.bucket
+
+        finished = []
+        if self._start is None:
+            self._start = start
+        elif start > self._start:
+            finished = self.flush()
+            self._start = start
+
+        key = (doc['schema'], doc['fingerprint'])
+        try:
+            group = self._groups[key]
+        except KeyError:
+            group = self._groups[key] = {
+                'schema': doc['schema'],
+                'fingerprint': doc['fingerprint'],
+                'query': doc['query']
+            }
+            for metric in self.metrics:
+                group[metric] = []
+
+        for metric in self.metrics:
+            group[metric].append(doc.get(metric, 0))
+
+        return finished
+
+
+    def flush(self):
+        """Return the digests of the open bucket and start over"""
+
+        if self._start is None:
+            return []
+
+        timestamp = datetime.fromtimestamp(self._start, pytz.utc)
+        digests = []
+        for group in self._groups.values():
+            digest = {
+                'timestamp': timestamp,
+                'bucket': self.bucket,
+                'schema': group['schema'],
+                'fingerprint': group['fingerprint'],
+                'query': group['query'],
+                'count': len(group['query-time'])
+            }
+
+            for metric in self.metrics:
+                values = sorted(group[metric])
+                digest[metric + '-sum'] = sum(values)
+                digest[metric + '-min'] = values[0]
+                digest[metric + '-max'] = values[-1]
+                digest[metric + '-p95'] = percentile(values, 95)
+                digest[metric + '-p99'] = percentile(values, 99)
+
+            digests.append(digest)
+
+        self._start = None
+        self._groups = {}
+        return digests
+
+
+class Histogram(object):
+    """
+    Count durations in buckets of milliseconds. Each bucket counts the
+    durations up to its bound that did not fit in the previous one.
+    """
+
+    bounds = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.total = 0.0
+
+
+    def add(self, seconds):
+        self.counts[bisect_left(self.bounds, seconds * 1000)] += 1
+        self.total += seconds
+
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+
+    def as_dict(self):
+        labels = ['{ms}ms'.format(ms=ms) for ms in self.bounds] + ['inf']
+        return dict(zip(labels, self.counts))
+
+
+def bulk_action(serializer, doc, _id=None, op='create'):
+    """
+    Document as an action line and a source line for the _bulk API. With an
+    _id op is create, to leave an existing document alone, or index, to
+    replace it.
+    """
+
+    if _id:
+        meta = {op: {'_id': _id}}
+    else:
+        meta = {'index': {}}
+
+    return '{action}\n{source}\n'.format(
+        action=serializer.dumps(meta),
+        source=serializer.dumps(doc)
+    )
+
+
+class BulkIndexer(object):
+    """
+    Buffer documents and send them to Elasticsearch using the _bulk API.
+
+    A batch is sent when it reaches max_docs documents or max_bytes of
+    serialized request body. Items rejected with 429 (queue full) are
+    retried with exponential backoff, other item errors are reported and
+    counted as failed.
+
+    Documents added with an ID are only created if they do not exist
+    already, those that do are counted as existing. With op index they
+    replace the existing document instead.
+
+    With max_latency a partial batch is also sent when its oldest document
+    has waited that many seconds, see flush_due(). lag is how many seconds
+    behind the newest document sent was.
+
+    The duration of every bulk request is counted in the latency histogram.
+
+    With concurrency above 1 full batches are sent by that many threads, so
+    parsing goes on while requests are in flight. add() blocks while another
+    concurrency batches are waiting, which holds back the parser when
+    Elasticsearch can not keep up. flush() waits for all of them.
+    """
+
+    def __init__(self, es, index, doc_type, **kwargs):
+        self._es = es
+        self._index = index
+        self._doc_type = doc_type
+        self._serializer = es.transport.serializer
+        self.max_docs = kwargs.get('max_docs', 500)
+        self.max_bytes = kwargs.get('max_bytes', 10485760)
+        self.max_retries = kwargs.get('max_retries', 3)
+        self.backoff = kwargs.get('backoff', 1)
+        self.max_latency = kwargs.get('max_latency')
+        self.verbose = kwargs.get('verbose', 0)
+        concurrency = kwargs.get('concurrency', 1)
+
+        self._buffer = []
+        self._buffer_bytes = 0
+        self._buffer_since = None
+        self._newest = None
+        self.lag = None
+
+        self._lock = Lock()
+        self._error = None
+        self._queue = Queue(concurrency)
+        self._workers = []
+        if concurrency > 1:
+            for _ in range(concurrency):
+                worker = Thread(target=self._work, daemon=True)
+                worker.start()
+                self._workers.append(worker)
+
+        self.created = 0
+        self.existing = 0
+        self.failed = 0
+        self.retried = 0
+        self.requests = 0
+        self.latency = Histogram()
+
+
+    def add(self, doc, _id=None, op='create'):
+        action = bulk_action(self._serializer, doc, _id, op)
+        size = len(action.encode('utf-8'))
+
+        if self._buffer and self._buffer_bytes + size > self.max_bytes:
+            self._submit()
+
+        if not self._buffer:
+            self._buffer_since = monotonic()
+        self._buffer.append(action)
+        self._buffer_bytes += size
+        self._newest = doc.get('timestamp')
+
+        if len(self._buffer) >= self.max_docs:
+            self._submit()
+        else:
+            self.flush_due()
+
+
+    def flush_due(self):
+        """Send the batch if it has waited max_latency, True if it was sent"""
+
+        if not self._buffer or self.max_latency is None:
+            return False
+
+        if monotonic() - self._buffer_since < self.max_latency:
+            return False
+
+        self.flush()
         return True
-    return False
+
+
+    @property
+    def pending(self):
+        """Documents buffered plus batches not sent yet"""
+
+        return len(self._buffer) + self._queue.unfinished_tasks
+
+
+    def flush(self):
+        """Send the batch being built and wait for all batches in flight"""
+
+        if self._buffer:
+            self._submit()
+
+        if self._workers:
+            self._queue.join()
+            self._raise_error()
+
+
+    def close(self):
+        self.flush()
+
+        for _ in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+
+
+    def _submit(self):
+        """
+        Send the batch being built, or queue it for the workers. The batch
+        stays in the buffer until it is handed over, so if sending or
+        queueing is interrupted close() sends it again.
+        """
+
+        batch = (self._buffer, self._newest)
+
+        if self._workers:
+            self._raise_error()
+            self._queue.put(batch)
+        else:
+            self._deliver(*batch)
+
+        self._buffer = []
+        self._buffer_bytes = 0
+
+
+    def _work(self):
+        while True:
+            batch = self._queue.get()
+            try:
+                if batch is None:
+                    return
+                self._deliver(*batch)
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+
+    def _raise_error(self):
+        """Raise an error from a worker in the calling thread"""
+
+        if self._error:
+            (error, self._error) = (self._error, None)
+            raise error
+
+
+    def _deliver(self, actions, newest):
+        """Send a batch, retrying rejected documents"""
+
+        attempt = 0
+        while actions:
+            if attempt:
+                with self._lock:
+                    self.retried += len(actions)
+                sleep(self.backoff * 2 ** (attempt - 1))
+
+            try:
+                rejected = self._send(actions)
+            except (ConnectionError, TransportError) as e:
+                if (isinstance(e, ConnectionError) or e.status_code == 429) \
+                   and attempt < self.max_retries:
+                    print('Bulk request failed, retrying: {error}'.format(
+                        error=str(e)
+                    ), file=stderr)
+                    attempt += 1
+                    continue
+                raise
+
+            if rejected and attempt >= self.max_retries:
+                with self._lock:
+                    self.failed += len(rejected)
+                print('Giving up on {count} rejected documents'.format(
+                    count=len(rejected)
+                ), file=stderr)
+                break
+
+            actions = rejected
+            attempt += 1
+
+        if isinstance(newest, datetime):
+            self.lag = max(time() - newest.timestamp(), 0)
+
+
+    def _send(self, actions):
+        """Send one bulk request, return list of actions to retry"""
+
+        started = monotonic()
+        try:
+            res = self._es.bulk(
+                body=''.join(actions),
+                index=self._index,
+                doc_type=self._doc_type
+            )
+        finally:
+            with self._lock:
+                self.latency.add(monotonic() - started)
+
+        with self._lock:
+            self.requests += 1
+
+            if not res.get('errors'):
+                self.created += len(actions)
+                return []
+
+            rejected = []
+            for action, item in zip(actions, res['items']):
+                result = item.get('create') or item.get('index', {})
+                status = result.get('status', 500)
+
+                if status < 300:
+                    self.created += 1
+                elif status == 409:
+                    self.existing += 1
+                elif status == 429:
+                    rejected.append(action)
+                else:
+                    self.failed += 1
+                    print('Failed to index document: {status} {error}'.format(
+                        status=status,
+                        error=repr(result.get('error'))
+                    ), file=stderr)
+                    if self.verbose > 1:
+                        print(action, file=stderr)
+
+            return rejected
+
+
+class FileSink(object):
+    """
+    Write documents to a file in batches of max_docs instead of sending them
+    to Elasticsearch. Has the same interface and counters as BulkIndexer so
+    either can be used by main().
+    """
+
+    def __init__(self, filename, **kwargs):
+        self.filename = filename
+        self.max_docs = kwargs.get('max_docs', 500)
+        self.max_latency = kwargs.get('max_latency')
+        self._serializer = JSONSerializer()
+
+        self._buffer = []
+        self._buffer_since = None
+        self.lag = None
+
+        self.created = 0
+        self.existing = 0
+        self.failed = 0
+        self.retried = 0
+        self.requests = 0
+        self.latency = Histogram()
+
+        self._open()
+
+
+    def _open(self):
+        if self.filename == '-':
+            self._fileobj = stdout
+        else:
+            self._fileobj = open(self.filename, 'w', encoding='utf-8',
+                                 newline='')
+
+
+    def add(self, doc, _id=None, op='create'):
+        if not self._buffer:
+            self._buffer_since = monotonic()
+        self._buffer.append((doc, _id, op))
+
+        if len(self._buffer) >= self.max_docs:
+            self.flush()
+        else:
+            self.flush_due()
+
+
+    @property
+    def pending(self):
+        return len(self._buffer)
+
+
+    def flush_due(self):
+        """Write the batch if it has waited max_latency, True if it was"""
+
+        if not self._buffer or self.max_latency is None:
+            return False
+
+        if monotonic() - self._buffer_since < self.max_latency:
+            return False
+
+        self.flush()
+        return True
+
+
+    def flush(self):
+        batch = self._buffer
+        self._buffer = []
+        if not batch:
+            return
+
+        started = monotonic()
+        self._write(batch)
+        self._fileobj.flush()
+        self.latency.add(monotonic() - started)
+        self.created += len(batch)
+        self.requests += 1
+
+        newest = batch[-1][0].get('timestamp')
+        if isinstance(newest, datetime):
+            self.lag = max(time() - newest.timestamp(), 0)
+
+
+    def close(self):
+        self.flush()
+        if self._fileobj is not stdout:
+            self._fileobj.close()
+
+
+    def _write(self, batch):
+        raise NotImplementedError
+
+
+class NDJSONSink(FileSink):
+    """One JSON document per line"""
+
+    def _write(self, batch):
+        self._fileobj.write(''.join(
+            self._serializer.dumps(doc) + '\n' for (doc, _id, op) in batch
+        ))
+
+
+class BulkFileSink(FileSink):
+    """
+    A body for the _bulk API, to load with curl --data-binary @file later
+    """
+
+    def _write(self, batch):
+        self._fileobj.write(''.join(
+            bulk_action(self._serializer, doc, _id, op)
+            for (doc, _id, op) in batch
+        ))
+
+
+class CSVSink(FileSink):
+    """
+    One column per field, the columns are the fields of the first batch.
+    Fields that only show up later are left out.
+    """
+
+    def _write(self, batch):
+        if not hasattr(self, '_writer'):
+            columns = []
+            for (doc, _id, op) in batch:
+                columns.extend(key for key in doc if key not in columns)
+
+            self._writer = csv.DictWriter(
+                self._fileobj,
+                columns,
+                extrasaction='ignore'
+            )
+            self._writer.writeheader()
+
+        self._writer.writerows(doc for (doc, _id, op) in batch)
+
+
+class ParquetSink(FileSink):
+    """
+    A Parquet file with one row group per batch, the schema is taken from
+    the first batch. Needs pyarrow.
+    """
+
+    def _open(self):
+        if pyarrow is None:
+            raise RuntimeError('Install pyarrow to write parquet files')
+        if self.filename == '-':
+            raise RuntimeError('The parquet sink needs an --output file')
+        self._fileobj = open(self.filename, 'wb')
+        self._writer = None
+
+
+    def _write(self, batch):
+        docs = [doc for (doc, _id, op) in batch]
+
+        if self._writer is None:
+            schema = pyarrow.Table.from_pylist(docs).schema
+            # Columns that are empty in the first batch hold strings later
+            for i, field in enumerate(schema):
+                if pyarrow.types.is_null(field.type):
+                    schema = schema.set(i, field.with_type(pyarrow.string()))
+
+            table = pyarrow.Table.from_pylist(docs, schema=schema)
+            self._writer = pyarrow.parquet.ParquetWriter(
+                self._fileobj,
+                schema
+            )
+        else:
+            table = pyarrow.Table.from_pylist(docs, schema=self._writer.schema)
+
+        self._writer.write_table(table)
+
+
+    def close(self):
+        self.flush()
+        if self._writer is not None:
+            self._writer.close()
+        self._fileobj.close()
+
+
+file_sinks = {
+    'ndjson': NDJSONSink,
+    'bulk': BulkFileSink,
+    'csv': CSVSink,
+    'parquet': ParquetSink
+}
+
+
+class Checkpoint(object):
+    """
+    Keep track of how far into the slow log entries have been imported in a
+    JSON state file, so the next run can seek() past them.
+
+    The state holds the inode and offset of the end of the last imported
+    entry, a hash of that entry to detect if the file was truncated or
+    replaced, and the time and database in effect at that point.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._position = None
+        self._previous = None
+        self._retired = []
+
+        try:
+            with open(filename) as fileobj:
+                self.state = json.load(fileobj)
+        except FileNotFoundError:
+            self.state = {}
+
+
+    @property
+    def time(self):
+        if self.state.get('time'):
+            return datetime.fromisoformat(self.state['time'])
+
+
+    @property
+    def schema(self):
+        return self.state.get('schema')
+
+
+    def _matches(self, fileobj):
+        """True if fileobj is the file in the state and unchanged up to it"""
+
+        st = os.fstat(fileobj.fileno())
+        if (st.st_dev, st.st_ino) != (self.state['device'], self.state['inode']):
+            return False
+
+        start = self.state['entry-offset']
+        end = self.state['offset']
+        if st.st_size < end:
+            return False
+
+        data = os.pread(fileobj.fileno(), end - start, start)
+        return hashlib.sha1(data).hexdigest() == self.state['entry-hash']
+
+
+    def _find_rotated(self, filename):
+        """Open the file in the state by looking for its inode next to log"""
+
+        directory = os.path.dirname(os.path.abspath(filename))
+        for dirent in os.scandir(directory):
+            if dirent.inode() != self.state['inode']:
+                continue
+            try:
+                return open(dirent.path, 'rb')
+            except OSError:
+                return None
+
+
+    def segments(self, fileobj):
+        """
+        List of (fileobj, offset, final) tuples to read, in order, to
+        continue the import into the current log in fileobj.
+        """
+
+        if self.state:
+            if self._matches(fileobj):
+                return [(fileobj, self.state['offset'], False)]
+
+            rotated = self._find_rotated(fileobj.name)
+            if rotated and self._matches(rotated):
+                return [
+                    (rotated, self.state['offset'], True),
+                    (fileobj, 0, False)
+                ]
+            if rotated:
+                rotated.close()
+
+            print('Log in {state} was truncated or removed, starting '
+                  'over'.format(state=self.filename), file=stderr)
+            self.state = {}
+
+        return [(fileobj, 0, False)]
+
+
+    def track(self, positions):
+        """
+        Generator of the entries from iter_segments() or follow_segments(),
+        remembering their position.
+        """
+
+        for position in positions:
+            self._previous = self._position
+            self._position = position
+            yield position[2]
+
+
+    def retire(self, fileobj):
+        """
+        Close a log that has been read once the checkpoint is past it, it
+        is needed to save the position of an entry in it until then.
+        """
+
+        self._retired.append(fileobj)
+        self._close_retired()
+
+
+    def _close_retired(self):
+        positions = [position for position in (self._position, self._previous)
+                     if position]
+        for fileobj in self._retired[:]:
+            if not any(position[0] is fileobj for position in positions):
+                self._retired.remove(fileobj)
+                close_log(fileobj)
+
+
+    def save(self, previous=False):
+        """
+        Write the position of the last entry returned to the state file, or
+        the one before it if previous is True.
+        """
+
+        position = self._previous if previous else self._position
+        if not position:
+            return
+
+        (fileobj, st, entry, start, end) = position
+        data = os.pread(fileobj.fileno(), end - start, start)
+
+        self.state = {
+            'device': st.st_dev,
+            'inode': st.st_ino,
+            'offset': end,
+            'entry-offset': start,
+            'entry-hash': hashlib.sha1(data).hexdigest(),
+            'time': entry['date'] and entry['date'].isoformat(),
+            'schema': entry['schema']
+        }
+
+        tmp_filename = self.filename + '.tmp'
+        with open(tmp_filename, 'w') as state_file:
+            json.dump(self.state, state_file)
+        os.replace(tmp_filename, self.filename)
+        self._close_retired()
 
 
 class ProcessLog(object):
+    """
+    Assemble complete entries from the lines, as bytes, of a mysql slow log.
+
+    Only the entry currently being read is held in memory, so use
+    iter_entries() to stream entries out of a log of any size.
+
+    lines and bytes_read count what the generators reading the log for this
+    parser have consumed so far, for the throughput stats.
+    """
 
     def __init__(self, **kwargs):
         self._date_format = kwargs.get('date_format')
-        self._time = None
-        self._summary = []
+        self._time = kwargs.get('time')
+        self._time_line = None
+        self._schema = kwargs.get('schema')
+        self._reset()
+
+        self.lines = 0
+        self.bytes_read = 0
 
+
+    def _reset(self):
         self._query_info = {}
         self._user_info = {}
-        self.ready = False
+        self._timestamp = None
+        self._query = []
 
 
     def _parse_time(self, line):
-        m = re.match(r'^# Time: (\d+)[\t\s]+([\d\:]+)', line)
+        # Many entries share the same second, so reuse the last result.
+        if line == self._time_line:
+            return self._time
+        self._time_line = line
+
+        m = time_regex.match(line)
 
         if not m:
             return None
 
         try:
-            dt = datetime.strptime(
-                '{date} {time}'.format(
-                    date=m.group(1),
-                    time=m.group(2)
-                ),
-                self._date_format
-            )
+            if self._date_format == default_date_format and m.group(2):
+                dt = parse_default_time(*m.groups())
+            else:
+                dt = datetime.strptime(
+                    b' '.join(g for g in m.groups() if g).decode(
+                        log_encoding
+                    ),
+                    self._date_format
+                )
         except Exception as e:
             print('Exception: {error}'.format(
                 error=str(e)
-            ))
+            ), file=stderr)
             return None
 
         return dt
-    
+
 
     def _parse_user(self, line):
-        regex = r'^# User@Host: ([^\b@]+)[\t\s]+@[\t\s]+\[([\d\.]+)\]'
-        m = re.match(regex, line)
+        (username, sep, host) = line[13:].partition(b' @ ')
+        m = host_regex.match(host)
 
-        if not m:
+        if not sep or not m:
             return None
 
-        return {
-            'username': m.group(1),
-            'ip-address': m.group(2)
+        user_info = {
+            'username': username.strip().decode(log_encoding),
+            'hostname': m.group(1).decode(log_encoding) or None,
+            'ip-address': m.group(2).decode(log_encoding) or None
         }
+        if m.group(3):
+            user_info['thread-id'] = int(m.group(3))
+        return user_info
+
+
+    def _parse_fields(self, line, pairs=None):
+        """
+        Parse a "# Key: value  Key: value" line into the query info.
+
+        Handles the standard Query_time line as well as the extended fields
+        written by Percona Server and MariaDB, like Thread_id, Schema, QC_hit,
+        Rows_affected, Bytes_sent, Full_scan and Tmp_tables.
+        """
+
+        if pairs is None:
+            # Split the line once when every other word is a key, which is
+            # the case unless a value is empty or has a colon in it.
+            words = line[2:].split()
+            if len(words) == 2 * line.count(b':'):
+                pairs = zip(words[0::2], words[1::2])
+            else:
+                pairs = fields_regex.findall(line)
 
+        query_info = self._query_info
 
-    def _parse_query(self, line):
-        regex = ('# Query_time: (\d+\.\d+)\s+'
-                 'Lock_time: (\d+\.\d+)\s+'
-                 'Rows_sent: (\d+)\s+'
-                 'Rows_examined: (\d+)')
-        m = re.match(regex, line)
-
-        if not m:
-            print('No amtch')
-            return None
+        for (key, value) in pairs:
+            try:
+                (name, convert) = field_types[key]
+            except KeyError:
+                if not key_regex.match(key):
+                    # Not a key after all, match the fields one by one.
+                    return self._parse_fields(
+                        line, fields_regex.findall(line)
+                    )
+                (name, convert) = field_types[key] = field_type(key)
+
+            if key == b'Schema:':
+                self._schema = value.decode(log_encoding)
+                continue
 
-        return {
-            'query-time': float(m.group(1)),
-            'block-time': float(m.group(2)),
-            'rows-sent': int(m.group(3)),
-            'rows-examined': int(m.group(4))
-        }
+            try:
+                query_info[name] = convert(value)
+            except (KeyError, ValueError):
+                # Leave out a numeric or Yes/No field that is neither.
+                pass
 
 
     def process_line(self, line):
-        if line.startswith('# Time: '):
-            self.time = self._parse_time(line)
+        """
+        Feed one line of the log. Returns the previous entry if this line
+        starts a new one, otherwise None.
+        """
+
+        entry = None
+        first = line[:1]
+
+        if first == b'#':
+            kind = line[2:6]
+
+            if kind == b'Time':
+                entry = self.flush()
+                self._time = self._parse_time(line)
+            elif kind == b'User':
+                entry = self.flush()
+                self._user_info = self._parse_user(line)
+            elif line[1:2] == b' ':
+                self._parse_fields(line)
+        elif 'query-time' not in self._query_info:
+            # Server startup headers between entries.
+            pass
+        elif first == b'u' and line.startswith(b'use '):
+            # Mysql only logs the database when it changes so it carries
+            # over to the following entries.
+            schema = line[4:].rstrip().rstrip(b';')
+            self._schema = schema.decode(log_encoding)
+        elif first == b'S' and line.startswith(b'SET timestamp='):
+            try:
+                self._timestamp = int(line[14:].rstrip().rstrip(b';'))
+            except ValueError:
+                self._query.append(line)
+        else:
+            self._query.append(line)
 
-        if line.startswith('# User@Host: '):
-            self._user_info = self._parse_user(line)
+        return entry
 
-        if line.startswith('# Query_time: '):
-            self.query_info = self._parse_query(line)
 
+    def flush(self):
+        """Return the entry being read, if it is complete, and start over"""
 
-    def commit(self):
-        self._summary.append({
-            'query_info': self._query_info,
-            'user_info': self._user_info,
-            'date': self._time
-        })
+        entry = None
+
+        if 'query-time' in self._query_info:
+            entry = {
+                'date': self._time,
+                'user_info': self._user_info or {},
+                'query_info': self._query_info,
+                'schema': self._schema,
+                'timestamp': self._timestamp,
+                'query': b''.join(self._query).strip().decode(log_encoding)
+            }
+
+        self._reset()
+        return entry
+
+
+    def iter_entries(self, fileobj):
+        """
+        Generator yielding one complete entry at a time from the lines of
+        the binary file object fileobj.
+        """
+
+        lines = 0
+        for line in fileobj:
+            lines += 1
+            entry = self.process_line(line)
+            if entry:
+                self.lines += lines
+                lines = 0
+                yield entry
+
+        self.lines += lines
+        entry = self.flush()
+        if entry:
+            yield entry
 
-        self._query_info = {}
-        self._user_info = {}
-        self.ready = False
 
-        
     @property
     def time(self):
         return self._time
 
-    @time.setter
-    def time(self, val):
-        self._time = val
-
 
     @property
-    def query_info(self):
-        return self._query_info
+    def schema(self):
+        return self._schema
 
-    @query_info.setter
-    def query_info(self, val):
-        self._query_info = val
-        self.ready = True
 
+def peak_rss():
+    """Peak resident memory of this process or a worker, in kilobytes"""
 
-    @property
-    def user_info(self):
-        if not self._user_info:
-            return {}
-        return self._user_info
+    return max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    )
 
 
-    @property
-    def summary(self):
-        return self._summary
+class Stats(object):
+    """
+    Throughput of an import: what the parser p has read, how long was spent
+    in the sink versus parsing, and the request latencies and lag of the
+    sink. Time spent waiting for the log to grow in follow mode is not
+    parsing.
+    """
 
+    def __init__(self, p, sink=None, waiter=None, interval=None):
+        self._p = p
+        self._sink = sink
+        self._waiter = waiter
+        self.interval = interval
+        self.started = monotonic()
+        self.index_time = 0.0
+        self._last = (self.started, 0, 0, 0, 0.0)
+
+
+    def timed(self, func, *args):
+        """Call func with args, counting the time spent as indexing"""
+
+        started = monotonic()
+        try:
+            return func(*args)
+        finally:
+            self.index_time += monotonic() - started
 
-    @property
-    def last(self):
-        if len(self._summary):
-            return self._summary[-1]
+
+    def due(self):
+        return bool(self.interval) and \
+            monotonic() - self._last[0] >= self.interval
+
+
+    def progress(self, entries):
+        """Rates since the previous progress line, or the start"""
+
+        now = monotonic()
+        (then, bytes_read, lines, entries_then, index_time) = self._last
+        self._last = (now, self._p.bytes_read, self._p.lines, entries,
+                      self.index_time)
+        elapsed = max(now - then, 1e-6)
+
+        progress = ('Read {mb:.1f} MB/s, {lines:.0f} lines/s, {entries:.0f} '
+                    'entries/s, {index:.0%} of the time in the sink').format(
+            mb=(self._p.bytes_read - bytes_read) / elapsed / 1048576,
+            lines=(self._p.lines - lines) / elapsed,
+            entries=(entries - entries_then) / elapsed,
+            index=(self.index_time - index_time) / elapsed
+        )
+
+        if self._sink and self._sink.lag is not None:
+            progress += ', lag {lag:.1f} seconds'.format(lag=self._sink.lag)
+
+        return progress
+
+
+    def summary(self, entries, skipped=0):
+        elapsed = max(monotonic() - self.started, 1e-6)
+        waited = self._waiter.waited if self._waiter else 0.0
+
+        summary = {
+            'seconds': elapsed,
+            'bytes': self._p.bytes_read,
+            'lines': self._p.lines,
+            'entries': entries,
+            'skipped': skipped,
+            'bytes-per-second': self._p.bytes_read / elapsed,
+            'lines-per-second': self._p.lines / elapsed,
+            'entries-per-second': entries / elapsed,
+            'parse-seconds': max(elapsed - self.index_time - waited, 0.0),
+            'index-seconds': self.index_time,
+            'wait-seconds': waited,
+            'peak-rss-kb': peak_rss()
+        }
+
+        if self._sink:
+            summary.update({
+                'requests': self._sink.requests,
+                'created': self._sink.created,
+                'existing': self._sink.existing,
+                'failed': self._sink.failed,
+                'retried': self._sink.retried,
+                'lag-seconds': self._sink.lag,
+                'request-seconds': self._sink.latency.total,
+                'request-latency': self._sink.latency.as_dict()
+            })
+
+        return summary
 
 
 def main(args, config):
-    es_servers = []
+    digest = None
+    if args.digest:
+        digest = Digest(args.digest)
 
-    server_string = '{protocol}://{hostname}:{port}'.format(
-        protocol=config.get('elasticsearch', 'protocol'),
-        hostname=config.get('elasticsearch', 'hostname'),
-        port=config.getint('elasticsearch', 'port')
-    )
-    es_servers.append(server_string)
-    es = Elasticsearch(es_servers)
+    max_latency = args.max_latency if args.follow else None
+
+    # Keep the verbose output out of documents written to stdout
+    report = stdout
+    if args.sink != 'elasticsearch' and args.output == '-':
+        report = stderr
+
+    if args.sink == 'elasticsearch':
+        es_servers = []
+
+        server_string = '{protocol}://{hostname}:{port}'.format(
+            protocol=config.get('elasticsearch', 'protocol'),
+            hostname=config.get('elasticsearch', 'hostname'),
+            port=config.getint('elasticsearch', 'port')
+        )
+        es_servers.append(server_string)
+        # One connection per bulk request in flight
+        es = Elasticsearch(es_servers, maxsize=max(args.concurrency, 10))
+
+        sink = BulkIndexer(
+            es,
+            default_index + '-digest' if digest else default_index,
+            'digest' if digest else 'log',
+            max_docs=args.bulk_size,
+            max_bytes=args.bulk_bytes,
+            max_retries=args.max_retries,
+            max_latency=max_latency,
+            concurrency=args.concurrency,
+            verbose=args.verbose
+        )
+    elif args.dry_run:
+        sink = None
+    else:
+        try:
+            sink = file_sinks[args.sink](
+                args.output,
+                max_docs=args.bulk_size,
+                max_latency=max_latency
+            )
+        except (OSError, RuntimeError) as e:
+            parser.error(str(e))
+
+    logfiles = expand_logfiles(args.logfile)
+    if not logfiles:
+        parser.error('No log files match {patterns}'.format(
+            patterns=' '.join(args.logfile)
+        ))
+
+    if args.state_file or args.follow or args.jobs > 1:
+        if len(logfiles) > 1 or is_compressed(logfiles[0]) or \
+           not os.path.isfile(logfiles[0]):
+            parser.error(('--state-file, --follow and --jobs require a single '
+                          'uncompressed regular file'))
+
+    if (args.state_file or args.follow) and args.jobs > 1:
+        parser.error('--state-file and --follow can not be used with --jobs')
+
+    try:
+        fileobj = open_log(logfiles[0])
+        # The other logs are opened one at a time as they are read, report
+        # any that can not be before importing anything.
+        for filename in logfiles[1:]:
+            if filename != '-':
+                open_log(filename).close()
+    except (OSError, RuntimeError) as e:
+        parser.error(str(e))
+
+    checkpoint = None
+    if args.state_file:
+        checkpoint = Checkpoint(args.state_file)
+        segments = checkpoint.segments(fileobj)
+    else:
+        segments = open_segments(fileobj, logfiles[1:])
 
     p = ProcessLog(
-        date_format=args.date_format
+        date_format=args.date_format,
+        time=checkpoint and checkpoint.time,
+        schema=checkpoint and checkpoint.schema
     )
 
+    try:
+        local_time = LocalTime(args.timezone)
+    except pytz.UnknownTimeZoneError:
+        parser.error('Unknown timezone: {tz}'.format(tz=args.timezone))
+
     start_from = None
     if args.start_from:
         start_from = datetime.strptime(
@@ -218,95 +1863,169 @@ def main(args, config):
             args.date_format
         )
 
+    waiter = None
+    if args.follow:
+        waiter = Waiter(logfiles[0], args.poll_interval)
+
+    stats = Stats(p, sink, waiter, args.stats_interval)
+
+    def ship(doc, _id, op='create'):
+        if args.dry_run:
+            print(doc)
+        else:
+            stats.timed(sink.add, doc, _id, op)
+
+    def on_idle():
+        if stats.due():
+            print(stats.progress(total_docs), file=report)
+
+        if args.dry_run or not stats.timed(sink.flush_due):
+            return
+
+        if checkpoint and not digest:
+            checkpoint.save()
+        if args.verbose and sink.lag is not None:
+            print('Lag: {lag:.1f} seconds'.format(lag=sink.lag), file=report)
+
     total_docs = 0
     skipped_docs = 0
-    created_docs = 0
-    for line in args.logfile:
-        p.process_line(line)
+    if args.jobs > 1:
+        entries = iter_entries_parallel(
+            p,
+            logfiles[0],
+            args.date_format,
+            args.jobs,
+            args.chunk_size
+        )
+    else:
+        if args.follow:
+            positions = follow_segments(
+                p,
+                list(segments),
+                waiter,
+                on_idle,
+                checkpoint.retire if checkpoint else close_log
+            )
+        else:
+            positions = iter_segments(
+                p,
+                segments,
+                checkpoint.retire if checkpoint else close_log
+            )
+
+        if checkpoint:
+            entries = checkpoint.track(positions)
+        else:
+            entries = (position[2] for position in positions)
+
+    # Stop following the log and finish up on kill as well as ^C.
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    interrupted = False
 
-        if p.ready:
+    try:
+        for entry in entries:
             total_docs += 1
 
+            if stats.due():
+                print(stats.progress(total_docs), file=report)
+
+            if not entry['date']:
+                if args.verbose > 1:
+                    print('Skipping doc without time', file=report)
+
+                skipped_docs += 1
+                continue
+
             if start_from:
-                if p.time < start_from:
+                if entry['date'] < start_from:
                     if args.verbose > 1:
-                        print('Skipping doc due to start-time')
+                        print('Skipping doc due to start-time', file=report)
 
                     skipped_docs += 1
                     continue
 
-            local_tz = pytz.timezone(default_timezone)
-            local_dt = local_tz.localize(p.time, is_dst=None)
-            utc_dt = local_dt.astimezone(pytz.utc)
+            utc_dt = local_time.to_utc(entry['date'])
 
-            try:
-                es_doc = {
-                    'timestamp': utc_dt,
-                    'username': p.user_info['username'],
-                    'ip-address': p.user_info['ip-address'],
-                    'query-time': p.query_info['query-time'],
-                    'block-time': p.query_info['block-time'],
-                    'rows-sent': p.query_info['rows-sent'],
-                    'rows-examined': p.query_info['rows-examined']
-                }
-            except KeyError as e:
+            user_info = entry['user_info']
+            query_info = entry['query_info']
+            if 'username' not in user_info:
                 if args.verbose > 1:
-                    raise
+                    print('Skipping doc without user', file=report)
+
+                skipped_docs += 1
                 continue
 
-            search_matches = [
-                { 'match': {'timestamp': utc_dt} },
-                #{ 'match': {'username': p.user_info['username']} },
-                #{ 'match': {'ip-address': p.user_info['ip-address']} },
-                { 'match': {'query-time': p.query_info['query-time']} },
-                #{ 'match': {'block-time': p.query_info['block-time']} },
-                #{ 'match': {'rows-examined': p.query_info['rows-examined']} },
-                #{ 'match': {'rows-sent': p.query_info['rows-sent']} },
-            ]
-            search_doc = {
-                'query': {
-                    'bool': {
-                        'must': search_matches
-                    }
-                }
+            es_doc = {
+                'timestamp': utc_dt,
+                'schema': entry['schema'],
+                'query': entry['query']
             }
-            # Not sure if this works as it should.
-            #if doc_exists(es, search_doc):
-            #    if args.verbose:
-            #        print('Document exists: {doc}'.format(
-            #            doc=repr(es_doc)
-            #        ))
-            #    skipped_docs += 1
-            #    continue
-
-            if args.dry_run:
-                print(p.last)
+            es_doc.update(user_info)
+            es_doc.update(query_info)
+
+            es_doc['fingerprint'] = fingerprint(entry['query'])
+
+            if digest:
+                digests = digest.add(es_doc)
+                # A bucket computed again replaces the one indexed before.
+                for digest_doc in digests:
+                    ship(digest_doc, doc_id(digest_doc, Digest.id_fields),
+                         'index')
+
+                # The entry that closed the bucket is part of the next one.
+                if digests and checkpoint and not args.dry_run:
+                    stats.timed(sink.flush)
+                    checkpoint.save(previous=True)
             else:
-                res = es.index(
-                    index=default_index,
-                    doc_type='log',
-                    body=es_doc
-                )
-
-                if args.verbose:
-                    print('Created ES index: {res}'.format(
-                        res=repr(res)
-                    ))
-                created_docs += 1
-
-            p.commit()
-
-    if args.verbose:
-        print('Created {created}, skipped {skipped} out of total {total}'.format(
-            created=created_docs,
+                ship(es_doc, doc_id(es_doc))
+
+                # Everything up to this entry is in Elasticsearch.
+                if checkpoint and not args.dry_run and not sink.pending:
+                    checkpoint.save()
+    except KeyboardInterrupt:
+        # The last entry might not have been shipped, thanks to the
+        # document IDs it is harmless to read it again.
+        interrupted = True
+
+    # With a checkpoint the open bucket is read again on the next run.
+    if digest and not checkpoint:
+        for digest_doc in digest.flush():
+            ship(digest_doc, doc_id(digest_doc, Digest.id_fields), 'index')
+
+    if not args.dry_run:
+        stats.timed(sink.close)
+
+    if checkpoint and not args.dry_run and not digest:
+        checkpoint.save(previous=interrupted)
+
+    if args.verbose and not args.dry_run:
+        print(('Created {created}, existing {existing}, failed {failed}, '
+               'skipped {skipped} out of total {total} in {requests} bulk '
+               'requests').format(
+            created=sink.created,
+            existing=sink.existing,
+            failed=sink.failed,
             skipped=skipped_docs,
-            total=total_docs
-        ))
+            total=total_docs,
+            requests=sink.requests
+        ), file=report)
+
+    if args.stats:
+        summary = json.dumps(stats.summary(total_docs, skipped_docs))
+        if args.stats == '-':
+            print(summary, file=report)
+        else:
+            with open(args.stats, 'w') as f:
+                f.write(summary + '\n')
 
 
 if __name__ == '__main__':
     args = parser.parse_args()
+    if args.sink == 'elasticsearch' and not args.config:
+        parser.error('--config is required for the elasticsearch sink')
+
     config = RawConfigParser()
-    config.readfp(args.config)
+    if args.config:
+        config.readfp(args.config)
 
     main(args, config)
@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 # Wrote this because GNU split can't 
 # split by regex and I just wanted 
 # a program like this available. 
@@ -7,30 +7,276 @@
 # a 3rd party module. 
 # Stupid Debian stable. 
 #
+# Can also be imported, iterSections() streams the sections of a dump
+# from any binary file object.
+#
 # by Stefan Midjich
 # CC0 - 2012
 
 LOG_FILE = 'splitsqldump.log'
 LOG_MAX_BYTES = 20971520
 LOG_MAX_COPIES = 2
+MAX_OPEN_FILES = 64
+BLOCK_SIZE = 1048576
 
+import io
+import os
 import sys
 import re
+import bz2
+import gzip
+import json
+import time
+import zlib
 import logging
+import threading
+import multiprocessing
+from fnmatch import fnmatchcase
+from collections import OrderedDict, deque
 from logging import handlers
+from queue import Queue
 import argparse
 
-# Setup logging
-formatter = logging.Formatter('%(asctime)s %(filename)s[%(process)s] %(levelname)s: %(message)s')
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Logs to LOG_FILE when run as a script, see main()
 l = logging.getLogger(__name__)
-h = handlers.RotatingFileHandler(
-    LOG_FILE, 
-    maxBytes=LOG_MAX_BYTES, 
-    backupCount=LOG_MAX_COPIES
+
+# Markers written by mysqldump, checked only on lines starting with --.
+# Marker lines are decoded before they are matched, database and table
+# names are str.
+dbRegex = re.compile('-- Current Database: `([^`]+)`')
+tableRegex = re.compile(
+    '-- (?:Table|Temporary table|Temporary view|Final view) structure for '
+    '(?:table|view) `([^`]+)`'
 )
-h.setFormatter(formatter)
-l.addHandler(h)
-l.setLevel(logging.INFO)
+dbSectionRegex = re.compile('-- Dumping (?:events|routines) for database')
+
+# Markers written by pg_dumpall
+pgDatabaseRegex = re.compile('-- Database "(.*)" dump$')
+pgConnectRegex = re.compile(
+    '\\\\connect (?:-reuse-previous=on )?'
+    '(?:"dbname=\'((?:[^\']|\'\')*)\'"|"((?:[^"]|"")*)"|(\\S+))'
+)
+pgObjectRegex = re.compile(
+    '-- (?:Data for )?Name: ([^;]+); Type: ([^;]+); Schema: ([^;]+);'
+)
+
+def openDump(filename):
+    """
+    Open a dump for reading as bytes, decompressing it if it starts with the
+    magic bytes of gzip, bzip2, xz or zstd. Returns the file and the name of
+    the compression, None if there is none.
+    """
+
+    f = open(filename, 'rb')
+    magic = f.read(6)
+    f.seek(0)
+
+    if magic.startswith(b'\x1f\x8b'):
+        return (gzip.GzipFile(fileobj=f, mode='rb'), 'gzip')
+    if magic.startswith(b'BZh'):
+        f.close()
+        return (bz2.BZ2File(filename, 'rb'), 'bzip2')
+    if magic.startswith(b'\xfd7zXZ\x00'):
+        if lzma is None:
+            raise RuntimeError('Python has no lzma module to read %s' % filename)
+        return (lzma.LZMAFile(f, 'rb'), 'xz')
+    if magic.startswith(b'\x28\xb5\x2f\xfd'):
+        if zstandard is None:
+            raise RuntimeError('Install zstandard to read %s' % filename)
+        return (zstandard.ZstdDecompressor().stream_reader(f), 'zstd')
+
+    return (f, None)
+
+class WorkerPool(object):
+    """
+    Threads calling functions submitted to them, for compressing chunks of
+    data and copying ranges of the dump. zlib, zstd and file I/O release
+    the GIL so the threads run in parallel.
+    """
+
+    class Job(object):
+        def __init__(self, func, data):
+            self.func = func
+            self.data = data
+            self.done = threading.Event()
+
+        def result(self):
+            self.done.wait()
+            return self.value
+
+    def __init__(self, threads):
+        self.threads = threads
+        self.queue = Queue()
+        self.workers = []
+        for i in range(threads):
+            t = threading.Thread(target=self.work)
+            t.daemon = True
+            t.start()
+            self.workers.append(t)
+
+    def submit(self, func, data):
+        job = self.Job(func, data)
+        self.queue.put(job)
+        return job
+
+    def close(self):
+        for t in self.workers:
+            self.queue.put(None)
+        for t in self.workers:
+            t.join()
+
+    def work(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            try:
+                job.value = job.func(job.data)
+            except Exception as e:
+                job.value = e
+            job.done.set()
+
+def gzipMember(data, level=6):
+    """data compressed as a complete gzip member"""
+
+    c = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return c.compress(data) + c.flush()
+
+class GzipOutput(object):
+    """
+    Gzip compress what is written to the binary file f, using pool to
+    compress chunks in parallel. Each chunk becomes a gzip member of its
+    own, concatenated members make up a valid gzip file like pigz writes.
+    """
+
+    def __init__(self, f, pool=None):
+        self.f = f
+        self.pool = pool
+        self.chunk = []
+        self.chunkSize = 0
+        self.pending = deque()
+
+    def write(self, data):
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        self.chunk.append(data)
+        self.chunkSize += len(data)
+        if self.chunkSize >= BLOCK_SIZE:
+            self.submit()
+
+    def submit(self):
+        data = b''.join(self.chunk)
+        self.chunk = []
+        self.chunkSize = 0
+
+        if self.pool is None:
+            self.f.write(gzipMember(data))
+            return
+
+        self.pending.append(self.pool.submit(gzipMember, data))
+        # Bound the memory used by chunks waiting to be written
+        while len(self.pending) > 2 * self.pool.threads:
+            self.writeResult(self.pending.popleft())
+
+    def writeResult(self, job):
+        result = job.result()
+        if isinstance(result, Exception):
+            raise result
+        self.f.write(result)
+
+    def flush(self):
+        if self.chunk:
+            self.submit()
+        while self.pending:
+            self.writeResult(self.pending.popleft())
+        self.f.flush()
+
+    def close(self):
+        self.flush()
+        self.f.close()
+
+# Output compression: file name suffix and how to wrap the file
+compressions = {
+    'gzip': ('.gz', lambda f, pool: GzipOutput(f, pool)),
+    'zstd': ('.zst', lambda f, pool: zstandard.ZstdCompressor(
+        threads=pool.threads if pool else 0
+    ).stream_writer(f)),
+}
+
+class OutputFiles(object):
+    """
+    Output files by name, at most maxOpen are kept open. The least recently
+    used file is closed when another one has to be opened, and opened again
+    for appending if it is written to later. With stdout all names are
+    written to stdout instead.
+
+    With compress, one of compressions, every file is compressed using
+    threads threads.
+    """
+
+    def __init__(self, maxOpen=MAX_OPEN_FILES, directory='.', stdout=False,
+                 compress=None, threads=1):
+        self.maxOpen = maxOpen
+        self.directory = directory
+        self.files = OrderedDict()
+        self.created = set()
+
+        self.suffix = ''
+        self.wrap = None
+        self.pool = None
+        if compress:
+            (self.suffix, self.wrap) = compressions[compress]
+            if threads > 1:
+                self.pool = WorkerPool(threads)
+
+        self.stdout = None
+        if stdout:
+            self.stdout = self.open(sys.stdout.fileno(), 'wb', closefd=False)
+
+    def open(self, name, mode, **kwargs):
+        f = io.open(name, mode, **kwargs)
+        if self.wrap is not None:
+            f = self.wrap(f, self.pool)
+        return f
+
+    def get(self, name):
+        if self.stdout is not None:
+            return self.stdout
+
+        f = self.files.pop(name, None)
+        if f is None:
+            while len(self.files) >= self.maxOpen:
+                self.files.popitem(last=False)[1].close()
+
+            # Views are dumped at the end, under a second Current Database.
+            # Compressed streams can be appended to as well.
+            mode = 'ab' if name in self.created else 'wb'
+            f = self.open(
+                os.path.join(self.directory, name + self.suffix),
+                mode
+            )
+            self.created.add(name)
+
+        self.files[name] = f
+        return f
+
+    def close(self):
+        while self.files:
+            self.files.popitem()[1].close()
+        if self.stdout is not None:
+            self.stdout.close()
+        if self.pool is not None:
+            self.pool.close()
 
 def main():
     # Initiate argument parser and add arguments
@@ -40,22 +286,95 @@ def main():
     )
     parser.add_argument(
         '-t', '--type', '--dbtype',
-        nargs=1,
         choices=[
             'mysql',
+            'postgresql',
         ],
-        default='mysql', # TODO: PG
+        default='mysql',
         dest='dbtype',
-        metavar='mysql',
-        help='Type of dump to parse, currently only mysql supported'
+        help=('Type of dump to parse, mysqldump or pg_dumpall in plain '
+              'format')
     )
     parser.add_argument(
         '-d', '--db', '--dbname', '--database',
-        nargs='?', #TODO: Support multiple
-        default='',
-        dest='dbname',
+        action='append',
+        default=[],
+        dest='dbnames',
         metavar='mySpecialDB',
-        help='Name of database to extract, will be created as name.sql in cwd'
+        help=('Name or glob pattern of databases to extract, each is '
+              'created as name.sql. Can be given more than once, all '
+              'databases by default.')
+    )
+    parser.add_argument(
+        '-T', '--tables',
+        action='store_true',
+        dest='tables',
+        help=('Split each database further into one file per table, '
+              'name.table.sql')
+    )
+    parser.add_argument(
+        '-o', '--output-dir',
+        default='.',
+        dest='outputDir',
+        metavar='DIR',
+        help='Directory to create the files in, default is cwd'
+    )
+    parser.add_argument(
+        '--max-open',
+        type=int,
+        default=MAX_OPEN_FILES,
+        dest='maxOpen',
+        metavar='N',
+        help='Max number of output files kept open at once'
+    )
+    parser.add_argument(
+        '-b', '--block-size',
+        type=int,
+        default=BLOCK_SIZE,
+        dest='blockSize',
+        metavar='BYTES',
+        help='Read the dump in blocks of this size'
+    )
+    parser.add_argument(
+        '-z', '--compress',
+        choices=sorted(compressions),
+        default=None,
+        dest='compress',
+        help=('Compress every output file, adding .gz or .zst to its name. '
+              'Compressed input is always read transparently.')
+    )
+    parser.add_argument(
+        '--threads',
+        type=int,
+        default=multiprocessing.cpu_count(),
+        dest='threads',
+        metavar='N',
+        help='Threads compressing output, default is the number of CPUs'
+    )
+    parser.add_argument(
+        '-j', '--jobs',
+        type=int,
+        default=1,
+        dest='jobs',
+        metavar='N',
+        help=('Find where each database is in the dump first, then copy '
+              'them to their files with N threads and report the '
+              'throughput of each. Needs an uncompressed dump file.')
+    )
+    parser.add_argument(
+        '--build-index',
+        action='store_true',
+        dest='buildIndex',
+        help=('Only write an index with the byte range of every database and '
+              'table in the dump. Later runs on the same dump seek straight '
+              'to the ranges they need.')
+    )
+    parser.add_argument(
+        '-i', '--index',
+        default=None,
+        dest='indexFile',
+        metavar='FILE',
+        help='Index file to use, default is the dump filename plus .idx'
     )
     parser.add_argument(
         '-s', '--stdout',
@@ -74,51 +393,500 @@ def main():
     # Parse the arguments
     args = parser.parse_args()
 
+    h = handlers.RotatingFileHandler(
+        LOG_FILE,
+        maxBytes=LOG_MAX_BYTES,
+        backupCount=LOG_MAX_COPIES
+    )
+    h.setFormatter(logging.Formatter(
+        '%(asctime)s %(filename)s[%(process)s] %(levelname)s: %(message)s'
+    ))
+    l.addHandler(h)
+    l.setLevel(logging.INFO)
+
+    compression = None
     try:
-        sqldump = open(args.filename, 'r')
-    except(OSError, IOError), e:
+        (sqldump, compression) = openDump(args.filename)
+    except OSError:
         l.critical('Could not open input file: %s' % args.filename)
         l.info('Trying to read from stdin')
-        sqldump = sys.stdin
-
-    newDump = None
-    # Loop through lines of db dump
-    for line in sqldump:
-        if line.startswith('-- Current Database:'):
-            dbName = ''
-
-            # Close any previously split db.
-            if newDump is not None and args.stdout is False:
-                if newDump.closed is False:
-                    newDump.close()
-
-            reMatch = re.search('-- Current Database: `([^`]+)`', line)
-            dbName = reMatch.group(1)
-            l.info('Found DB name: %s' % dbName)
-            if dbName == '':
-                l.info('Do not support blank db names')
+        sqldump = sys.stdin.buffer
+    except RuntimeError as e:
+        l.critical(str(e))
+        return False
+
+    if compression:
+        l.info('Reading %s compressed dump' % compression)
+
+    if args.compress == 'zstd' and zstandard is None:
+        l.critical('Install zstandard to compress output with zstd')
+        return False
+
+    indexFile = args.indexFile or '%s.idx' % args.filename
+    # Offsets in the index are in the dump as stored, so it only works on
+    # a plain file.
+    seekable = sqldump is not sys.stdin.buffer and compression is None
+
+    if args.buildIndex:
+        if not seekable:
+            l.critical('Can only index an uncompressed dump file')
+            return False
+        return buildIndex(sqldump, args, indexFile)
+
+    sections = None
+    if seekable:
+        sections = loadIndex(sqldump, indexFile, args.dbtype)
+
+    parallel = args.jobs > 1 and not args.stdout
+    if parallel and not seekable:
+        l.info('Can only copy an uncompressed dump file in parallel')
+        parallel = False
+    if parallel and sections is None:
+        sections = scanSections(sqldump, args.dbtype, args.blockSize)
+
+    outputs = OutputFiles(
+        max(args.maxOpen, 1),
+        args.outputDir,
+        args.stdout,
+        args.compress,
+        args.threads
+    )
+    try:
+        if parallel:
+            return extractParallel(args.filename, args, outputs, sections)
+        if sections is not None:
+            return extract(sqldump, args, outputs, sections)
+        return split(sqldump, args, outputs)
+    finally:
+        outputs.close()
+
+def parseMarker(line, dbName):
+    """
+    Check a line starting with -- for the markers written by mysqldump.
+    Returns the database being dumped from here, and the table, '' for the
+    parts of the database outside any table or None if the line is not a
+    marker.
+    """
+
+    reMatch = dbRegex.match(line)
+    if reMatch:
+        dbName = reMatch.group(1)
+        l.info('Found DB name: %s' % dbName)
+        if dbName == '':
+            l.info('Do not support blank db names')
+            dbName = None
+        return (dbName, '')
+
+    if dbName is not None:
+        reMatch = tableRegex.match(line)
+        if reMatch:
+            return (dbName, reMatch.group(1))
+        if dbSectionRegex.match(line):
+            return (dbName, '')
+
+    return (dbName, None)
+
+def outputName(dbName, table, args):
+    """File a database or table goes to, None if it was not selected"""
+
+    if dbName is None:
+        return None
+    if args.dbnames and not any(fnmatchcase(dbName, p) for p in args.dbnames):
+        return None
+    if args.tables and table:
+        return '%s.%s.sql' % (dbName, table)
+    return '%s.sql' % dbName
+
+def parsePgMarker(line, dbName):
+    """parseMarker() for the lines pg_dumpall writes"""
+
+    # pg_dumpall of PostgreSQL 11 and later has a comment before the
+    # CREATE DATABASE, older ones only the \connect after it.
+    reMatch = pgDatabaseRegex.match(line)
+    if reMatch:
+        l.info('Found DB name: %s' % reMatch.group(1))
+        return (reMatch.group(1), '')
+
+    reMatch = pgConnectRegex.match(line)
+    if reMatch:
+        (dbnameQuoted, quoted, plain) = reMatch.groups()
+        if dbnameQuoted is not None:
+            name = dbnameQuoted.replace("\'\'", "\'")
+        elif quoted is not None:
+            name = quoted.replace('""', '"')
+        else:
+            name = plain
+        if name == dbName:
+            return (dbName, None)
+        l.info('Found DB name: %s' % name)
+        return (name, '')
+
+    if dbName is not None:
+        reMatch = pgObjectRegex.match(line)
+        if reMatch:
+            (name, objectType, schema) = reMatch.groups()
+            if objectType in ('TABLE', 'TABLE DATA'):
+                return (dbName, '%s.%s' % (schema, name))
+            return (dbName, '')
+
+    return (dbName, None)
+
+def findLine(data, prefix, start, end, lineStart):
+    """Offset of the first line from start to end starting with prefix"""
+
+    if lineStart and data.startswith(prefix, start, end):
+        return start
+    i = data.find(b'\n' + prefix, start, end)
+    return -1 if i == -1 else i + 1
+
+def markerLines(data, end, lineStart=True, state=None):
+    """
+    Offsets of the lines starting with "-- " in data up to end. lineStart
+    is False when data starts in the middle of a line.
+    """
+
+    if lineStart and data.startswith(b'-- ', 0, end):
+        yield 0
+
+    i = data.find(b'\n-- ', 0, end)
+    while i != -1:
+        yield i + 1
+        i = data.find(b'\n-- ', i + 1, end)
+
+def pgMarkerLines(data, end, lineStart=True, state=None):
+    """
+    markerLines() for pg_dumpall, also yielding \\connect lines. The rows
+    of COPY blocks are skipped over without looking at them, state keeps
+    track of a COPY block going on into the next block of data.
+    """
+
+    start = 0
+    found = {}
+    while True:
+        if state.get('copy'):
+            i = findLine(data, b'\\.\n', start, end, lineStart)
+            if i == -1:
+                return
+            state['copy'] = False
+            (start, lineStart) = (i + 3, True)
+            found = {}
+
+        # Each prefix is only searched for again once it has been passed
+        for prefix in (b'-- ', b'\\connect ', b'COPY '):
+            i = found.get(prefix)
+            if i is None or -1 < i < start:
+                found[prefix] = findLine(data, prefix, start, end, lineStart)
+        offsets = [i for i in found.values() if i != -1]
+        if not offsets:
+            return
+
+        i = min(offsets)
+        if data.startswith(b'COPY ', i):
+            lineEnd = data.find(b'\n', i, end)
+            if lineEnd == -1:
+                return
+            if data[i:lineEnd].rstrip().endswith(b'FROM stdin;'):
+                state['copy'] = True
+            (start, lineStart) = (lineEnd + 1, True)
+            continue
+
+        yield i
+        (start, lineStart) = (i + 1, False)
+
+# Per type of dump, the prefixes of marker lines and how to find and
+# parse them.
+dialects = {
+    'mysql': ((b'-- ',), markerLines, parseMarker),
+    'postgresql': ((b'-- ', b'\\connect ', b'COPY ', b'\\.'),
+                   pgMarkerLines, parsePgMarker),
+}
+
+def iterSections(sqldump, dbtype='mysql', blockSize=BLOCK_SIZE):
+    """
+    Read the dump from the binary file sqldump and yield it as
+    (database, table, span) in order, where span is a memoryview of the
+    bytes of the dump in that section. table is '' for the parts of a
+    database outside any table and database is None for what comes before
+    the first one. A section is yielded in several spans when it goes on
+    past a block of blockSize bytes, joined together the spans are the
+    whole dump.
+
+    The dump is only searched for lines that can be markers, the data
+    between two markers is yielded as a single span no matter how many
+    lines it has.
+    """
+
+    (prefixes, findMarkers, parse) = dialects[dbtype]
+    state = {}
+
+    dbName = None
+    table = ''
+    carry = b''
+    lineStart = True
+
+    while True:
+        block = sqldump.read(blockSize)
+        data = carry + block if carry else block
+
+        end = len(data)
+        if block:
+            # Keep a last line that could be a marker for the next block.
+            end = data.rfind(b'\n') + 1
+            partial = data[end:end + 16]
+            if (end == 0 and not lineStart) or not any(
+                p.startswith(partial[:len(p)]) for p in prefixes
+            ):
+                end = len(data)
+
+        view = memoryview(data)
+        pos = 0
+        for start in findMarkers(data, end, lineStart, state):
+            lineEnd = data.find(b'\n', start, end)
+            lineEnd = end if lineEnd == -1 else lineEnd + 1
+
+            line = data[start:lineEnd].decode('utf-8', 'surrogateescape')
+            (newDbName, newTable) = parse(line, dbName)
+            if newTable is None:
                 continue
 
-            if args.dbname is not None:
-                if args.dbname != dbName:
-                    if newDump is not None:
-                        if newDump.closed is False: newDump.close()
-                    newDump = None
-                    continue
+            if start > pos:
+                yield (dbName, table, view[pos:start])
+            pos = start
+            (dbName, table) = (newDbName, newTable)
+
+        if end > pos:
+            yield (dbName, table, view[pos:end])
+
+        if not block:
+            return
+
+        carry = data[end:]
+        lineStart = bool(carry) or data.endswith(b'\n')
+
+def split(sqldump, args, outputs):
+    """
+    Write every selected database in sqldump to its own file in a single
+    pass, or to stdout.
+    """
 
-            if args.stdout is False:
-                try:
-                    newDump = open('%s.sql' % dbName, 'w')
-                except(OSError, IOError), e:
-                    l.critical('Could not open output file: %s.sql' % dbName)
-                    return False
+    for (dbName, table, span) in iterSections(sqldump, args.dbtype,
+                                              args.blockSize):
+        name = outputName(dbName, table, args)
+        if name is None:
+            continue
 
-        # Write line to file
-        if newDump is not None:
-            if newDump.closed is False: newDump.write(line)
+        try:
+            outputs.get(name).write(span)
+        except OSError:
+            l.critical('Could not open output file: %s' % name)
+            return False
 
     return True
 
+def scanSections(sqldump, dbtype='mysql', blockSize=BLOCK_SIZE):
+    """
+    [database, table, start, end] of every section of every database in
+    sqldump, by byte offset.
+    """
+
+    sections = []
+    offset = 0
+    for (dbName, table, span) in iterSections(sqldump, dbtype, blockSize):
+        size = len(span)
+        if dbName is not None:
+            last = sections[-1] if sections else None
+            if last and last[:2] == [dbName, table] and last[3] == offset:
+                last[3] += size
+            else:
+                sections.append([dbName, table, offset, offset + size])
+        offset += size
+    return sections
+
+def buildIndex(sqldump, args, indexFile):
+    """
+    Write the byte ranges of all databases and tables in sqldump to
+    indexFile, along with the size and mtime of the dump to tell when the
+    index is out of date.
+    """
+
+    sections = scanSections(sqldump, args.dbtype, args.blockSize)
+    st = os.fstat(sqldump.fileno())
+
+    try:
+        with open(indexFile, 'w') as f:
+            json.dump({
+                'type': args.dbtype,
+                'size': st.st_size,
+                'mtime': st.st_mtime,
+                'sections': sections
+            }, f)
+    except OSError:
+        l.critical('Could not write index file: %s' % indexFile)
+        return False
+
+    l.info('Wrote %d sections to index %s' % (len(sections), indexFile))
+    return True
+
+def loadIndex(sqldump, indexFile, dbtype):
+    """Sections of the index for sqldump, None if there is no valid index"""
+
+    try:
+        with open(indexFile) as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    st = os.fstat(sqldump.fileno())
+    if index.get('size') != st.st_size or index.get('mtime') != st.st_mtime:
+        l.info('Index %s is out of date, scanning the dump' % indexFile)
+        return None
+    if index.get('type', 'mysql') != dbtype:
+        l.info('Index %s is for another type of dump' % indexFile)
+        return None
+
+    return index['sections']
+
+def copyRange(src, dst, start, length):
+    """
+    Copy length bytes from start in the file src to the end of dst, inside
+    the kernel where the os module supports it.
+    """
+
+    # Compressed outputs have to go through Python
+    kernelCopy = []
+    if isinstance(dst, io.IOBase):
+        dst.flush()
+        kernelCopy = [getattr(os, 'copy_file_range', None),
+                      getattr(os, 'sendfile', None)]
+
+    for copy in kernelCopy:
+        if copy is None:
+            continue
+        try:
+            while length > 0:
+                if copy is os.sendfile:
+                    copied = copy(dst.fileno(), src.fileno(), start, length)
+                else:
+                    copied = copy(src.fileno(), dst.fileno(), length, start)
+                if not copied:
+                    break
+                start += copied
+                length -= copied
+            if not length:
+                return
+        except OSError:
+            # Not supported between these files, like with O_APPEND.
+            continue
+
+    src.seek(start)
+    while length > 0:
+        data = src.read(min(length, BLOCK_SIZE))
+        if not data:
+            break
+        dst.write(data)
+        length -= len(data)
+
+def extract(sqldump, args, outputs, sections):
+    """Copy the selected databases in sqldump by the ranges in its index"""
+
+    for (dbName, table, start, end) in sections:
+        name = outputName(dbName, table, args)
+        if name is None:
+            continue
+
+        try:
+            newDump = outputs.get(name)
+        except OSError:
+            l.critical('Could not open output file: %s' % name)
+            return False
+
+        copyRange(sqldump, newDump, start, end - start)
+
+    return True
+
+def copySections(filename, outputs, path, ranges):
+    """
+    Copy the byte ranges of the dump in filename to a new file at path.
+    Returns the number of bytes copied and how many seconds it took.
+    """
+
+    started = time.time()
+    copied = 0
+    with open(filename, 'rb') as src:
+        dst = outputs.open(path, 'wb')
+        try:
+            for (start, end) in ranges:
+                copyRange(src, dst, start, end - start)
+                copied += end - start
+        finally:
+            dst.close()
+    return (copied, time.time() - started)
+
+def extractParallel(filename, args, outputs, sections):
+    """
+    Copy the selected databases in the dump file by the ranges in sections,
+    with one thread per output file at a time. Every thread reads the dump
+    through a file of its own.
+    """
+
+    files = OrderedDict()
+    for (dbName, table, start, end) in sections:
+        name = outputName(dbName, table, args)
+        if name is not None:
+            files.setdefault((dbName, name), []).append((start, end))
+
+    started = time.time()
+    pool = WorkerPool(max(args.jobs, 1))
+    jobs = []
+    try:
+        for ((dbName, name), ranges) in files.items():
+            path = os.path.join(outputs.directory, name + outputs.suffix)
+            jobs.append((dbName, name, pool.submit(
+                lambda job: copySections(*job),
+                (filename, outputs, path, ranges)
+            )))
+
+        databases = OrderedDict()
+        for (dbName, name, job) in jobs:
+            result = job.result()
+            if isinstance(result, Exception):
+                l.critical('Could not write output file: %s: %s' % (
+                    name,
+                    result
+                ))
+                return False
+            (copied, seconds) = databases.get(dbName, (0, 0.0))
+            databases[dbName] = (copied + result[0], seconds + result[1])
+    finally:
+        pool.close()
+
+    report(databases, time.time() - started)
+    return True
+
+def report(databases, elapsed):
+    """Log and print bytes copied and throughput per database"""
+
+    lines = []
+    total = 0
+    for (dbName, (copied, seconds)) in databases.items():
+        total += copied
+        lines.append('%-32s %12d bytes %8.2fs %8.1f MB/s' % (
+            dbName,
+            copied,
+            seconds,
+            copied / max(seconds, 1e-6) / 1048576
+        ))
+    lines.append('%-32s %12d bytes %8.2fs %8.1f MB/s' % (
+        'Total',
+        total,
+        elapsed,
+        total / max(elapsed, 1e-6) / 1048576
+    ))
+
+    for line in lines:
+        l.info(line)
+        sys.stderr.write(line + '\n')
+
 if __name__ == '__main__':
     if main():
         sys.exit(0)